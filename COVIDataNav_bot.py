@@ -4,35 +4,93 @@ Bot de Telegram de COVIDataNav
 Está basado en el ejemplo de Python-Telegram-Bot de 
 https://github.com/python-telegram-bot/python-telegram-bot/blob/master/examples/timerbot.py
 
-Acepta 6 comandos:
+Acepta 9 comandos:
 /start - Muestra la información general del bot y da una explicación del funcionamiento
 /ver <localdiad> - Envía los casos positivos en el último día, los últimos 15 días y los
                    casos desde el inicio de la pandemia junto con una gráfica de evolución para la localidad elegida.
-Deshabilitado -- /configurar <localidad> <hora entre 0 y 23> - Permite configurar un envío diario de los datos que devuelve /ver a una hora elegida (entre 0 y 23)
-Deshabilitado -- /desconfigurar - Elimina el envío diario
+/ver <localidad> <días> - Lo mismo y además los casos de los últimos <días> días
+/ver <localidad> <dd/mm/aaaa> <dd/mm/aaaa> - Lo mismo y además los casos entre esas dos fechas
+/zona <zona básica> - Envía las mismas cifras para una zona básica de salud y la lista de sus municipios.
+                      También acepta <días> o dos fechas como /ver
+/ranking [n] - Envía los n municipios (10 por defecto) con más casos en los últimos 15 días y, si se conoce
+                su población, con más casos por 100.000 habitantes
+/configurar <localidad> <hora entre 0 y 23> - Permite configurar un envío diario de los datos que devuelve /ver a una hora elegida (entre 0 y 23)
+/desconfigurar - Elimina el envío diario
 /info - Muestra información sobre el Bot
 /help - Muestra la lista de comandos
-
-Para identificar un municipio desde la entrada de un usuario se usa get_close_matches
-de difflib.
-
-Versión 1.1.1
+/stats - Solo para los administradores (ADMINS): latencias del bot y tiempos de la última actualización
+
+También funciona en modo inline (hay que activarlo con /setinline en BotFather): escribiendo
+@<bot> <localidad> en cualquier chat se muestran, mientras se escribe, los municipios cuyo
+nombre en Castellano o en Euskera empieza por lo escrito (o, si no hay ninguno, los más
+parecidos) con sus datos y, si ya se ha subido, su gráfica. Sin texto se muestran los que
+tienen más casos en los últimos 15 días.
+
+Para identificar un municipio desde la entrada de un usuario se usa un índice de
+nombres (ver indice_municipios.py) que da los mismos resultados que get_close_matches
+de difflib sin tener que comparar con todos los municipios.
+
+Los datos de los municipios se leen de la instantánea que publica data_updater.py
+en Publicado/ (ver publicacion.py): el almacén Datos_municipios.bin (ver
+almacen.py), los índices de nombres ya construidos de Manifiesto.json y las
+gráficas. Cada RECARGA segundos se mira si se ha publicado una nueva y, si es
+así, se carga y se sustituye la anterior sin reiniciar el bot. Cada handler toma
+la instantánea actual al empezar y la usa hasta el final, así que nunca mezcla
+datos de dos publicaciones.
+
+Las consultas inline llegan con cada letra que se escribe, así que no tocan el
+disco: los municipios y los textos de cada consulta se calculan una vez y se
+guardan en la instantánea (Instantanea.memo, como mucho MAX_MEMO_INLINE), que se
+descarta entera al cargar otra, y las gráficas se mandan con los file_id que
+ya están en memoria. Lo que solo hace falta a veces (graficas.py y los
+procesos de dibujo, telegram.ext) se importa cuando se usa.
+
+Las gráficas solo se suben a Telegram la primera vez que se piden. Después se
+manda el file_id que devuelve Telegram, que se guarda en file_ids.json junto
+con la versión de la gráfica para saber cuándo hay que volver a subirla.
+
+Los handlers son corrutinas de asyncio (python-telegram-bot >= 20). La escritura
+de archivos se hace en otro hilo para no bloquear el bucle, se atienden a la vez
+como mucho MAX_CONCURRENCIA actualizaciones y se suben como mucho MAX_SUBIDAS
+gráficas a la vez.
+
+Las suscripciones de /configurar se guardan en suscripciones.db (ver
+suscripciones.py). Cada hora se ejecuta un único envío que manda los datos a
+todos los suscritos a esa hora: el texto de cada municipio se prepara una vez
+y los mensajes salen de una cola a MENSAJES_POR_SEGUNDO como mucho para
+respetar los límites de Telegram.
+
+Si data_updater.py se ha ejecutado con --bajo-demanda las gráficas no están en
+Datos_municipios: se dibujan la primera vez que se piden en PROCESOS_DIBUJO
+procesos y se guardan en una caché LRU en memoria y en Cache_graficas/ (ver
+graficas.py). Al arrancar se dibujan las PRECALENTAR más pedidas en ver_history.txt
+en los últimos DIAS_DEMANDA días.
+
+La latencia de ver, button y los envíos programados se mide por fases
+(búsqueda del municipio, lectura de sus datos, envío del texto, lectura de la
+gráfica y subida; en los programados, aparte, la espera del ritmo) y se guarda
+cada minuto en formato Prometheus en metricas_bot.prom (ver metricas.py).
+
+Versión 1.2
 
 Daniel Enériz Orta
 """
 
+import asyncio
+import functools
 import logging
-from difflib import get_close_matches
-from os import listdir
-from parse import *
-import numpy as np
-import json
 import datetime as dt
+import json
+import os
 import time
-import pytz
-from random import random
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, JobQueue
+from collections import Counter, defaultdict
+from zoneinfo import ZoneInfo
+from publicacion import Instantanea, Vigilante
+from indice_municipios import Normaliza
+from metricas import metricas, LeeValores
+from suscripciones import Suscripciones
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # Enable logging
 logging.basicConfig(
@@ -41,35 +99,260 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-# Cargamos la lista de municipios
-municipios = np.array(listdir('./Datos_municipios/'))
-orig_municipios = municipios
+MAX_CONCURRENCIA = 256 # Actualizaciones que se atienden a la vez
+MAX_SUBIDAS = 8        # Gráficas que se suben a Telegram a la vez
+
+MENSAJES_POR_SEGUNDO = 25 # Ritmo de los envíos programados (Telegram permite unos 30 por segundo)
+TRABAJADORES_ENVIO = 8    # Envíos programados que se hacen a la vez
+ZONA_HORARIA = ZoneInfo('Europe/Madrid')
+
+ADMINS = set() # chat_id de los administradores, que pueden usar /stats
+METRICAS = './metricas_bot.prom'
+METRICAS_UPDATER = './metricas_updater.prom'
+
+RANKING = 10       # Municipios que muestra /ranking por defecto
+MAX_RANKING = 50   # y como mucho, para que el mensaje no pase del límite de Telegram
+
+PROCESOS_DIBUJO = 2                 # Procesos para dibujar las gráficas bajo demanda
+MAX_CACHE_MEMORIA = 32*1024*1024    # Bytes de gráficas en memoria
+MAX_CACHE_DISCO = 128*1024*1024     # Bytes de gráficas en Cache_graficas/
+PRECALENTAR = 20                    # Gráficas más pedidas que se dibujan al arrancar
+DIAS_DEMANDA = 30                   # Días de ver_history.txt que se usan para saber cuáles son
+
+RECARGA = 30 # Cada cuántos segundos se mira si hay una instantánea nueva de los datos
+
+INLINE = 10             # Resultados de una consulta inline
+MAX_MEMO_INLINE = 4096  # Consultas inline distintas cuyos resultados se guardan en cada instantánea
+CACHE_INLINE = 60       # Segundos que Telegram puede reutilizar la respuesta a una consulta inline
+
+# Mide lo que tarda una fase de un handler
+def Tramo(handler, fase):
+    return metricas.tramo('bot_latencia_segundos', histograma=True, handler=handler, fase=fase)
 
-# Los procesamos para poder identificarlos tanto en Castellano como en Euskera
-for mun in municipios:
-    if '_' in mun:
-        municipios = np.append(municipios, mun.split('_'))
+# Decorador que mide lo que tarda un handler entero
+def Con_latencia(handler):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def envoltura(*args, **kwargs):
+            with Tramo(handler, 'total'):
+                return await funcion(*args, **kwargs)
+        return envoltura
+    return decorador
+
+
+# Cargamos la instantánea actual de los datos: el almacén con los datos de todos los municipios,
+# el índice de municipios para poder identificarlos tanto en Castellano como en Euskera y el de
+# las zonas básicas, para /zona. Se sustituye entera cuando se publica otra (ver recarga)
+vigilante = Vigilante()
+actual = Instantanea(vigilante.cambiada())
+vigilante.cargada(actual.directorio)
 
 # Nos permite identificar los 4 municipio de la lista más 'similares' al de la entrada
 def Identifica_municipio(mun_in):
+    return actual.indice.identifica(mun_in)
+
+
+# Texto con los datos de una zona básica tal y como los devuelve Almacen.datos_zona
+def Texto_zona(data):
+    return ('Datos de la zona básica {} del {}:\n'
+            'Casos en el último día: {}\n'
+            'Casos en los últimos 15 días: {}\n'
+            'Casos acumulados desde el inicio: {}\n'
+            'Municipios: {}'.format(data['Zona'], data['Fecha'], data['Datos']['CasosUltimoDia'], data['Datos']['Casos15dias'], data['Datos']['CasosAcum'],
+                                    ', '.join(data['Municipios'])))
+
+
+# Abrimos las suscripciones a los envíos diarios
+suscripciones = Suscripciones('./suscripciones.db')
+
+# Texto con los datos de un municipio tal y como los devuelve Almacen.datos
+def Texto_datos(data):
+    return ('Datos de {} del {}:\n'
+            'Casos en el último día: {}\n'
+            'Casos en los últimos 15 días: {}\n'
+            'Casos acumulados desde el inicio: {}'.format(data['Municipio'], data['Fecha'], data['Datos']['CasosUltimoDia'], data['Datos']['Casos15dias'], data['Datos']['CasosAcum']))
+
+
+# Los casos de cualquier ventana de días salen de los acumulados del almacén (ver
+# Almacen.casos), así que no hace falta recorrer los datos de cada día
+FORMATO_FECHA = '%d/%m/%Y'
+
+# Separa la ventana de días del final de los argumentos de /ver. Devuelve los
+# argumentos de la localidad y la ventana: None, un número de días o (desde, hasta)
+def Lee_ventana(args):
+    if len(args) > 1 and args[-1].isdigit():
+        return args[:-1], int(args[-1])
+
+    if len(args) > 2:
+        try:
+            desde, hasta = (dt.datetime.strptime(arg, FORMATO_FECHA).date() for arg in args[-2:])
+        except(ValueError):
+            return args, None
+        return args[:-2], (desde, hasta)
+
+    return args, None
+
+def Escribe_ventana(ventana):
+    if isinstance(ventana, int):
+        return str(ventana)
+    return ' '.join(fecha.strftime(FORMATO_FECHA) for fecha in ventana)
+
+# Línea con los casos de la ventana, que se añade al texto de Texto_datos (o al de
+# Texto_zona si `zona`). Los días y las fechas fuera de los datos se recortan y se
+# muestran los que se han usado, o se avisa si no hay ningún día con datos entre ellas
+def Texto_ventana(almacen, municipio, ventana, zona=False):
+    casos = almacen.casos_zona if zona else almacen.casos
+
+    if isinstance(ventana, int):
+        ventana = min(ventana, almacen.dias-1) # El primer día del almacén es anterior al primer dato
+        return '\nCasos en los últimos {} días: {}'.format(ventana, casos(municipio, almacen.dias-ventana))
+
+    desde, hasta = ventana
+    primera = dt.date.fromisoformat(almacen.inicio) + dt.timedelta(days=1)
+    ultima = primera + dt.timedelta(days=almacen.dias-2)
+
+    if hasta < primera or desde > ultima:
+        return '\nNo hay datos del {} al {}, los datos van del {} al {}'.format(desde.strftime(FORMATO_FECHA), hasta.strftime(FORMATO_FECHA),
+                                                                               primera.strftime(FORMATO_FECHA), ultima.strftime(FORMATO_FECHA))
+
+    desde, hasta = max(desde, primera), min(hasta, ultima)
+    return '\nCasos del {} al {}: {}'.format(desde.strftime(FORMATO_FECHA), hasta.strftime(FORMATO_FECHA),
+                                             casos(municipio, almacen.columna(desde), almacen.columna(hasta)))
+
+# callback_data de los botones de /ver: el municipio y, si la hay, la ventana
+def Opcion(municipio, ventana):
+    if ventana is None:
+        return municipio
+    return '{}|{}'.format(municipio, Escribe_ventana(ventana))
+
+# Teclado con las opciones [(texto, callback_data)] de dos en dos, como mucho 4
+def Teclado(opciones):
+    botones = [InlineKeyboardButton(texto, callback_data=dato) for texto, dato in opciones[:4]]
+    return InlineKeyboardMarkup([botones[i:i+2] for i in range(0, len(botones), 2)])
+
+
+# Cargamos los file_id de las gráficas que ya se han subido a Telegram
+FILE_IDS = './file_ids.json'
+
+try:
+    with open(FILE_IDS) as json_file:
+        file_ids = json.load(json_file) # {municipio: [versión de la gráfica, file_id]}
+except(FileNotFoundError):
+    file_ids = {}
+
+subidas = asyncio.Semaphore(MAX_SUBIDAS)
+subiendo = defaultdict(asyncio.Lock) # Para no subir a la vez la misma gráfica varias veces
+guardando_file_ids = asyncio.Lock()
+
+def GuardaFileIds(copia):
+    with open(FILE_IDS+'.tmp', 'w') as json_fout:
+        json.dump(copia, json_fout)
+    os.replace(FILE_IDS+'.tmp', FILE_IDS)
+
+def LeeArchivo(ruta):
+    with open(ruta, 'rb') as fin:
+        return fin.read()
+
+def GuardaPeticion(ruta, linea):
+    with open(ruta, 'a') as file:
+        file.write(linea)
+
+# Caché de las gráficas dibujadas bajo demanda y procesos que las dibujan. Se crean (y se
+# importa graficas.py) la primera vez que hace falta dibujar una, para no retrasar el arranque
+cache_graficas = None
+dibujantes = None
+
+# PNG de la gráfica de un municipio en la instantánea `datos`: el que ha dejado data_updater.py
+# o, si no está (--bajo-demanda), el de la caché o uno dibujado en ese momento
+async def Grafica(datos, municipio, handler):
+    global cache_graficas, dibujantes
+
+    try:
+        with Tramo(handler, 'lectura'):
+            return await asyncio.to_thread(LeeArchivo, datos.grafica(municipio))
+    except(FileNotFoundError):
+        pass
+
+    import concurrent.futures
+    from graficas import CacheGraficas, Dibuja, InicializaProceso
+
+    if cache_graficas is None:
+        cache_graficas = CacheGraficas('./Cache_graficas', MAX_CACHE_MEMORIA, MAX_CACHE_DISCO)
+
+    almacen = datos.almacen
+    clave = (municipio, almacen.version(municipio))
+
+    with Tramo(handler, 'cache'):
+        png = await asyncio.to_thread(cache_graficas.get, clave)
+
+    if png is None:
+        # Si los procesos que dibujan se han roto (ha muerto uno o ha fallado InicializaProceso)
+        # se crean otros y se vuelve a intentar una vez
+        for intento in range(2):
+            if dibujantes is None:
+                dibujantes = concurrent.futures.ProcessPoolExecutor(max_workers=PROCESOS_DIBUJO, initializer=InicializaProceso)
+            rotos = dibujantes
+
+            try:
+                with Tramo(handler, 'dibujo'):
+                    png = await asyncio.get_running_loop().run_in_executor(dibujantes, Dibuja, municipio, almacen.inicio,
+                                                                           almacen.nuevos(municipio).tolist(), almacen.acumulados(municipio).tolist())
+                break
+            except(concurrent.futures.process.BrokenProcessPool):
+                if intento == 1:
+                    raise
+                logger.warning('Los procesos de dibujo se han roto, se vuelven a crear')
+                if dibujantes is rotos: # Puede que otro handler ya los haya cambiado
+                    dibujantes = None
+                rotos.shutdown(wait=False)
 
-    mun_cercanos = get_close_matches(mun_in.upper(), municipios)
+        await asyncio.to_thread(cache_graficas.put, clave, png)
 
-    mun_orig_cercanos=[]
-    
-    for i in range(len(mun_cercanos)): # Llevamos la opciones a la lista de munuicipio originales
-        for mun in orig_municipios:
-            if (mun_cercanos[i] in mun) and (mun not in mun_orig_cercanos):
-                mun_orig_cercanos.append(mun)
-    
-    return(mun_orig_cercanos)
+    return png
+
+# Manda la gráfica de un municipio de la instantánea `datos` con `enviar` (reply_photo, send_photo...).
+# Si esta versión de la gráfica ya se ha subido se manda su file_id en lugar del archivo, sin
+# esperar a nadie. Solo la subida se hace con el cerrojo del municipio, para no subirla varias veces
+async def Manda_grafica(enviar, datos, municipio, handler):
+
+    version = datos.almacen.version(municipio)
+    rechazado = None # file_id que Telegram ya no reconoce
+
+    while True:
+        guardado = file_ids.get(municipio)
+        if guardado is not None and guardado[0] == version and guardado[1] != rechazado:
+            try:
+                with Tramo(handler, 'subida'):
+                    return await enviar(guardado[1])
+            except(BadRequest): # Telegram ya no reconoce el file_id, lo volvemos a subir
+                logger.warning('file_id de %s no válido, se vuelve a subir la gráfica', municipio)
+                rechazado = guardado[1]
+
+        async with subiendo[municipio]:
+            guardado = file_ids.get(municipio)
+            if guardado is not None and guardado[0] == version and guardado[1] != rechazado:
+                continue # Otro la ha subido mientras esperábamos, se manda su file_id fuera del cerrojo
+
+            foto = await Grafica(datos, municipio, handler)
+
+            async with subidas:
+                with Tramo(handler, 'subida'):
+                    mensaje = await enviar(foto)
+
+            file_ids[municipio] = [version, mensaje.photo[-1].file_id]
+            break
+
+    async with guardando_file_ids: # Se escribe en otro hilo, uno cada vez
+        await asyncio.to_thread(GuardaFileIds, dict(file_ids))
+
+    return mensaje
 
 
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
-def start(update, context):
+async def start(update, context):
     """Send a message when the command /start is issued."""
-    update.message.reply_text("Hola\! \nEste bot esta hecho para consultar los datos sobre *PCRs"
+    await update.message.reply_text("Hola\! \nEste bot esta hecho para consultar los datos sobre *PCRs"
                               " positivas* en cada localidad de Navarra en base a los *datos pub"
                               "ilicados por el Gobierno de Navarra* en este [link](https://gobiernoabierto.navarra.es/es/open-data/datos/positivos-covid-19-por-pcr-distruidos-por-municipio)\.\n\n"
                               "*NO ES UN CANAL OFICIAL*\n\n"
@@ -81,9 +364,9 @@ def start(update, context):
                               "Para mas información sobre los datos y sobre el bot usa el comando /info\. Usando /help te mandaré la lista de comandos disponibles\.", parse_mode='MarkdownV2')
 
 
-def info(update, context):
+async def info(update, context):
     """Send a message when the command /start is issued."""
-    update.message.reply_text("Este bot esta hecho para consultar los datos sobre *PCRs"
+    await update.message.reply_text("Este bot esta hecho para consultar los datos sobre *PCRs"
                               " positivas* en cada localidad de Navarra en base a los *datos pub"
                               "ilicados por el Gobierno de Navarra* en este [link](https://gobiernoabierto.navarra.es/es/open-data/datos/positivos-covid-19-por-pcr-distruidos-por-municipio)\.\n\n"
                               "Si consultas la página verás que tienen colgado un documento `\.csv`"
@@ -102,236 +385,480 @@ def info(update, context):
                               " producto, o proceso divulgado\.", parse_mode='MarkdownV2')
 
 
-def help_command(update, context):
+async def help_command(update, context):
     """Send a message when the command /help is issued."""
-    update.message.reply_text("Los comandos que puedes usar son:\n"
+    await update.message.reply_text("Los comandos que puedes usar son:\n"
                                "/ver `<localidad>` - Muestra los datos de una localidad en concreto\n"
+                               "/ver `<localidad>` `<días>` - Añade los casos de los últimos días, por ejemplo /ver Pamplona 7\n"
+                               "/ver `<localidad>` `<dd/mm/aaaa>` `<dd/mm/aaaa>` - Añade los casos entre esas dos fechas\n"
+                               "/zona `<zona básica>` - Muestra los datos de una zona básica de salud\n"
+                               "/ranking `[n]` - Muestra los n municipios con más casos en los últimos 15 días\n"
+                               "También puedes escribir el nombre del bot seguido de una localidad en cualquier chat para mandar sus datos\n"
                                "/configurar `<localidad>` `<hora entre 0 y 23>` - Permite configurar una localidad para recibir las actualizaciones en los datos cada vez que el Gobierno de Navarra las actualiza\n"
                                "/desconfigurar - Permite eliminar el aviso diario de la localidad configurada previamente\n"
                                "/info - Muestra información sobre los datos y sobre el bot\n"
                                "/help - Muestra la lista de comandos disponibles", parse_mode='MarkdownV2')
 
 
-def ver(update, context):
+@Con_latencia('ver')
+async def ver(update, context):
 
     if len(context.args) == 0:
-        update.message.reply_text('Uso: /ver <localidad>\nPor ejemplo: /ver Pamplona')
+        await update.message.reply_text('Uso: /ver <localidad>\nPor ejemplo: /ver Pamplona\n\nTambién puedes pedir los casos de los últimos días (/ver Pamplona 7) o entre dos fechas (/ver Pamplona 01/10/2020 15/10/2020)')
         return
 
-    for arg in context.args:
-        if '<' or '>' in arg:
-            update.message.reply_text('Uso: /ver <localidad>\nPor ejemplo: /ver Pamplona')
+    if any(('<' in arg) or ('>' in arg) for arg in context.args):
+        await update.message.reply_text('Uso: /ver <localidad>\nPor ejemplo: /ver Pamplona\n\nTambién puedes pedir los casos de los últimos días (/ver Pamplona 7) o entre dos fechas (/ver Pamplona 01/10/2020 15/10/2020)')
         return
 
-    with open('./ver_history.txt', 'a') as file: # Guardamos las peticiones
-        file.write('{} {}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), ' '.join(context.args)))
+    # Guardamos las peticiones
+    await asyncio.to_thread(GuardaPeticion, './ver_history.txt', '{} {}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), ' '.join(context.args)))
 
 
-    # args[0] should contain the time for the timer in seconds
-    municipios = Identifica_municipio(' '.join(context.args))
+    localidad, ventana = Lee_ventana(context.args)
+
+    if ventana is not None and not (ventana >= 1 if isinstance(ventana, int) else ventana[0] <= ventana[1]):
+        await update.message.reply_text('El número de días tiene que ser al menos 1 y la primera fecha no puede ser posterior a la segunda')
+        return
+
+    datos = actual # La misma instantánea hasta el final, aunque se publique otra mientras tanto
+
+    with Tramo('ver', 'busqueda'):
+        municipios = datos.indice.identifica(' '.join(localidad))
 
     if len(municipios) == 0:
-        update.message.reply_text('Uso: /ver <localidad>\nPor ejemplo: /ver Pamplona\n\n Si no aparecen opciones para tu localidad es que no se ha registrado ningún caso.')
+        await update.message.reply_text('Uso: /ver <localidad>\nPor ejemplo: /ver Pamplona\n\n Si no aparecen opciones para tu localidad es que no se ha registrado ningún caso.')
         return
 
     if len(municipios) > 1:
-        if len(municipios) == 2:
+        reply_markup = Teclado([(municipio, Opcion(municipio, ventana)) for municipio in municipios])
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(municipios[0], callback_data=municipios[0]),
-                    InlineKeyboardButton(municipios[1], callback_data=municipios[1]),
-                ],
-            ]
+        await update.message.reply_text('*Elige entre estas opciones*\.\nSi tu localidad no aparece y has escrito bien el nombre es que aún no se ha registrado ningún caso\.', reply_markup=reply_markup, parse_mode='MarkdownV2')
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    else:
+        municipio = municipios[0]
+        with Tramo('ver', 'lectura_datos'):
+            texto = Texto_datos(datos.almacen.datos(municipio))
+            if ventana is not None:
+                texto += Texto_ventana(datos.almacen, municipio, ventana)
 
-            update.message.reply_text('*Elige entre estas opciones*\.\nSi tu localidad no aparece y has escrito bien el nombre es que aún no se ha registrado ningún caso\.', reply_markup=reply_markup, parse_mode='MarkdownV2')
+        with Tramo('ver', 'texto'):
+            await update.message.reply_text(texto)
 
-        elif len(municipios) == 3:
+        await Manda_grafica(update.message.reply_photo, datos, municipio, 'ver')
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(municipios[0], callback_data=municipios[0]),
-                    InlineKeyboardButton(municipios[1], callback_data=municipios[1]),
-                ],
-                [ InlineKeyboardButton(municipios[2], callback_data=municipios[2]),]
-            ]
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
+@Con_latencia('button')
+async def button(update, context):
+    query = update.callback_query
 
-            update.message.reply_text('*Elige entre estas opciones*\.\nSi tu localidad no aparece y has escrito bien el nombre es que aún no se ha registrado ningún caso\.', reply_markup=reply_markup, parse_mode='MarkdownV2')
-        
-        else:
+    # CallbackQueries need to be answered, even if no notification to the user is needed
+    # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
+    await query.answer()
 
-            keyboard = [
-                [
-                    InlineKeyboardButton(municipios[0], callback_data=municipios[0]),
-                    InlineKeyboardButton(municipios[1], callback_data=municipios[1]),
-                ],
-                [
-                    InlineKeyboardButton(municipios[2], callback_data=municipios[2]),
-                    InlineKeyboardButton(municipios[3], callback_data=municipios[3]),
-                ],
-            ]
+    municipio, _, ventana = query.data.partition('|')
+    _, ventana = Lee_ventana([municipio]+ventana.split())
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    datos = actual
 
-            update.message.reply_text('*Elige entre estas opciones*\.\nSi tu localidad no aparece y has escrito bien el nombre es que aún no se ha registrado ningún caso\.', reply_markup=reply_markup, parse_mode='MarkdownV2')
+    with Tramo('button', 'lectura_datos'):
+        texto = Texto_datos(datos.almacen.datos(municipio))
+        if ventana is not None:
+            texto += Texto_ventana(datos.almacen, municipio, ventana)
 
-    else:
-        municipio = municipios[0]
-        with open('./Datos_municipios/{}/{}_data.json'.format(municipio, municipio)) as json_file:
-            data = json.load(json_file)
+    with Tramo('button', 'texto'):
+        await query.edit_message_text(text = texto)
+    
+    await Manda_grafica(query.message.reply_photo, datos, municipio, 'button')
+
+
+
+USO_ZONA = 'Uso: /zona <zona básica>\nPor ejemplo: /zona Rochapea\n\nTambién puedes pedir los casos de los últimos días (/zona Rochapea 7) o entre dos fechas (/zona Rochapea 01/10/2020 15/10/2020)'
+
+def Texto_zona_ventana(almacen, z, ventana):
+    texto = Texto_zona(almacen.datos_zona(z))
+    if ventana is not None:
+        texto += Texto_ventana(almacen, z, ventana, zona=True)
+    return texto
+
+# Las zonas básicas salen del mismo cubo que los municipios (ver data_updater.TotalesZonas)
+# y sus cifras de los acumulados del almacén. Los botones llevan 'ZONA|' delante
+@Con_latencia('zona')
+async def zona(update, context):
+
+    if len(context.args) == 0 or any(('<' in arg) or ('>' in arg) for arg in context.args):
+        await update.message.reply_text(USO_ZONA)
+        return
+
+    localidad, ventana = Lee_ventana(context.args)
+
+    if ventana is not None and not (ventana >= 1 if isinstance(ventana, int) else ventana[0] <= ventana[1]):
+        await update.message.reply_text('El número de días tiene que ser al menos 1 y la primera fecha no puede ser posterior a la segunda')
+        return
 
-            update.message.reply_text('Datos de {} del {}:\n'
-                                        'Casos en el último día: {}\n'
-                                        'Casos en los últimos 15 días: {}\n'
-                                        'Casos acumulados desde el inicio: {}'.format(data['Municipio'], data['Fecha'], data['Datos']['CasosUltimoDia'], data['Datos']['Casos15dias'], data['Datos']['CasosAcum']))
+    datos = actual
 
-        update.message.reply_photo(open('./Datos_municipios/{}/{}_plot.png'.format(municipio,municipio),'rb'))
+    with Tramo('zona', 'busqueda'):
+        zonas = datos.indice_zonas.identifica(' '.join(localidad))
 
+    if len(zonas) == 0:
+        await update.message.reply_text(USO_ZONA)
+        return
 
-def button(update, context):
+    if len(zonas) > 1:
+        reply_markup = Teclado([(z, 'ZONA|'+Opcion(z, ventana)) for z in zonas])
+        await update.message.reply_text('*Elige entre estas zonas básicas*\.', reply_markup=reply_markup, parse_mode='MarkdownV2')
+        return
+
+    with Tramo('zona', 'texto'):
+        await update.message.reply_text(Texto_zona_ventana(datos.almacen, zonas[0], ventana))
+
+
+@Con_latencia('button_zona')
+async def button_zona(update, context):
     query = update.callback_query
+    await query.answer()
 
-    # CallbackQueries need to be answered, even if no notification to the user is needed
-    # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
-    query.answer()
+    z, _, ventana = query.data[len('ZONA|'):].partition('|')
+    _, ventana = Lee_ventana([z]+ventana.split())
 
-    municipio = query.data
+    with Tramo('button_zona', 'texto'):
+        await query.edit_message_text(text = Texto_zona_ventana(actual.almacen, z, ventana))
 
-    with open('./Datos_municipios/{}/{}_data.json'.format(municipio, municipio)) as json_file:
-        data = json.load(json_file)
 
-        query.edit_message_text(text = 'Datos de {} del {}:\n'
-                                    'Casos en el último día: {}\n'
-                                    'Casos en los últimos 15 días: {}\n'
-                                    'Casos acumulados desde el inicio: {}'.format(data['Municipio'], data['Fecha'], data['Datos']['CasosUltimoDia'], data['Datos']['Casos15dias'], data['Datos']['CasosAcum']))
-    
-    query.message.reply_photo(open('./Datos_municipios/{}/{}_plot.png'.format(municipio,municipio),'rb'))
+# El ranking viene ya ordenado en el almacén (lo calcula data_updater.py), solo hay que cortarlo
+@Con_latencia('ranking')
+async def ranking(update, context):
 
+    if len(context.args) > 1 or (context.args and not context.args[0].isdigit()):
+        await update.message.reply_text('Uso: /ranking [número de municipios, como mucho {}]\nPor ejemplo: /ranking 20'.format(MAX_RANKING))
+        return
 
+    n = min(max(int(context.args[0]), 1), MAX_RANKING) if context.args else RANKING
 
-def configurar(update, context):
+    almacen = actual.almacen
 
-    update.message.reply_text('He encontrado problemas en esta función y he decidido desactivarla temporalmente.')
-    
-    """
+    with Tramo('ranking', 'busqueda'):
+        lineas = ['Municipios con más casos en los últimos 15 días ({}):'.format(almacen.fecha)]
+        lineas += ['{}. {}: {}'.format(i+1, municipio, casos) for i, (municipio, casos) in enumerate(almacen.ranking('Casos15dias', n))]
+
+        incidencia = almacen.ranking('Incidencia15dias', n)
+        if incidencia:
+            lineas.append('\nCasos por 100.000 habitantes en los últimos 15 días:')
+            lineas += ['{}. {}: {}'.format(i+1, municipio, valor) for i, (municipio, valor) in enumerate(incidencia)]
+
+    with Tramo('ranking', 'texto'):
+        await update.message.reply_text('\n'.join(lineas))
+
+
+# Municipios de una consulta inline en la instantánea `datos` con el texto y la descripción
+# de cada uno. Se calculan una vez por consulta distinta (sin tildes ni mayúsculas) y se
+# guardan en la instantánea, de la que se van quitando las usadas hace más tiempo
+def Resultados_inline(datos, consulta):
+    clave = Normaliza(consulta).strip()
+
+    resultados = datos.memo.get(clave)
+    if resultados is not None:
+        datos.memo.move_to_end(clave)
+        return resultados
+
+    if clave:
+        municipios = datos.indice.empiezan(clave, INLINE) or datos.indice.identifica(clave)
+    else:
+        municipios = [municipio for municipio, casos in datos.almacen.ranking('Casos15dias', INLINE)]
+
+    resultados = []
+    for municipio in municipios:
+        data = datos.almacen.datos(municipio)
+        descripcion = 'Último día: {}, últimos 15 días: {}'.format(data['Datos']['CasosUltimoDia'], data['Datos']['Casos15dias'])
+        resultados.append((municipio, Texto_datos(data), descripcion))
 
-    if len(context.args) != 2:
-        update.message.reply_text('Uso: /configurar <localidad> <hora (entre 0 y 23)>\nPor ejemplo: /configurar Pamplona 10')
+    datos.memo[clave] = resultados
+    if len(datos.memo) > MAX_MEMO_INLINE:
+        datos.memo.popitem(last=False)
+    return resultados
+
+# Consultas inline (@bot <localidad>). La gráfica solo se manda si esta versión ya se ha
+# subido alguna vez, con su file_id; si no, solo el texto
+@Con_latencia('inline')
+async def inline(update, context):
+    query = update.inline_query
+
+    datos = actual
+
+    with Tramo('inline', 'busqueda'):
+        respuesta = []
+        for municipio, texto, descripcion in Resultados_inline(datos, query.query):
+            identificador = str(datos.almacen.indice[municipio])
+            guardado = file_ids.get(municipio)
+
+            if guardado is not None and guardado[0] == datos.almacen.version(municipio):
+                respuesta.append(InlineQueryResultCachedPhoto(identificador, guardado[1], title=municipio, description=descripcion, caption=texto))
+            else:
+                respuesta.append(InlineQueryResultArticle(identificador, municipio, InputTextMessageContent(texto), description=descripcion))
+
+    with Tramo('inline', 'texto'):
+        await query.answer(respuesta, cache_time=CACHE_INLINE)
+
+
+async def configurar(update, context):
+
+    if len(context.args) < 2 or not context.args[-1].isdigit():
+        await update.message.reply_text('Uso: /configurar <localidad> <hora (entre 0 y 23)>\nPor ejemplo: /configurar Pamplona 10')
         return
 
-    #Add a job to the queue
     chat_id = update.message.chat_id
-    
-    # args[0] should contain the time for the timer in seconds
-    municipio = Identifica_municipio(context.args[0])[0]
+    localidad = ' '.join(context.args[:-1])
+    hora = int(context.args[-1])
 
-    if not(0<=int(context.args[1])<24):
-        update.message.reply_text('Tienes que mandar una hora entre 0 y 23')
+    if not(0<=hora<24):
+        await update.message.reply_text('Tienes que mandar una hora entre 0 y 23')
         return
 
-    with open('./configurar_history.txt', 'a') as file: # Guardamos las peticiones
-        file.write('{} {} {} {}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), municipio, context.args[0], context.args[1]))
+    municipios = Identifica_municipio(localidad)
 
-    with open('./active_jobs.txt', 'a') as file: # Guardamos las peticiones
-        file.write('{} {} {}\n'.format(chat_id, municipio, context.args[1]))
+    if len(municipios) == 0:
+        await update.message.reply_text('No encuentro la localidad {}. Si has escrito bien el nombre es que aún no se ha registrado ningún caso.'.format(localidad))
+        return
 
-    hora = dt.time(hour=int(context.args[1]), minute=int(random()*5), tzinfo=pytz.timezone("Europe/Madrid"))
+    municipio = municipios[0]
 
-    # Add job to queue and stop current one if there is a timer already
-    if 'job' in context.chat_data:
-        old_job = context.chat_data['job']
-        old_job.schedule_removal()
-    new_job = context.job_queue.run_daily(mandar_configurado, hora, context={"chat_id": chat_id, "municipio": municipio})
-    context.chat_data['job'] = new_job
+    # Guardamos las peticiones
+    await asyncio.to_thread(GuardaPeticion, './configurar_history.txt', '{} {} {} {}\n'.format(time.strftime('%Y-%m-%dT%H:%M:%S'), municipio, localidad, hora))
 
-    update.message.reply_text('Te mandaré los datos de {} todos los días sobre las {}'.format(municipio, hora.strftime('%H:00')))
+    # Si el chat ya tenía un municipio configurado se sustituye
+    anterior = await asyncio.to_thread(suscripciones.de_chat, chat_id)
+    await asyncio.to_thread(suscripciones.suscribe, chat_id, municipio, hora)
 
-    """
+    texto = 'Te mandaré los datos de {} todos los días sobre las {}'.format(municipio, dt.time(hour=hora).strftime('%H:00'))
+    if anterior is not None and anterior != (municipio, hora):
+        texto += ' en lugar de los de {} sobre las {}'.format(anterior[0], dt.time(hour=anterior[1]).strftime('%H:00'))
+    await update.message.reply_text(texto)
 
-def desconfigurar(update, context):
+
+async def desconfigurar(update, context):
     """Remove the job if the user changed their mind."""
 
-    update.message.reply_text('He encontrado problemas en esta función y he decidido desactivarla temporalmente.')
+    anterior = await asyncio.to_thread(suscripciones.de_chat, update.message.chat_id)
 
-    """
-    
-    if 'job' not in context.chat_data:
-        update.message.reply_text('No tienes ningún municipio configurado')
+    if anterior is None or not await asyncio.to_thread(suscripciones.desuscribe, update.message.chat_id):
+        await update.message.reply_text('No tienes ningún municipio configurado')
         return
 
-    with open('./active_jobs.txt', 'r') as file: # Guardamos las peticiones
-        lines = file.readlines()
-        for i in range(len(lines)):
-            if str(update.message.chat_id) in lines[i]:
-                del(lines[i])
-                break
-    
-    with open('./active_jobs.txt', 'w+') as file: # Guardamos las peticiones
-        for line in lines:
-            file.write(line)
-
-    job = context.chat_data['job']
-    job.schedule_removal()
-    del context.chat_data['job']
+    await update.message.reply_text('Municipio desconfigurado correctamente, ya no te mandaré los datos de {} sobre las {}'.format(
+        anterior[0], dt.time(hour=anterior[1]).strftime('%H:00')))
+
+
+# Espaciado de los envíos programados: cada llamada a espera() devuelve como
+# pronto 1/por_segundo segundos después de la anterior
+class Ritmo:
+
+    def __init__(self, por_segundo):
+        self._intervalo = 1/por_segundo
+        self._siguiente = 0
+
+    async def espera(self):
+        ahora = asyncio.get_running_loop().time()
+        turno = max(ahora, self._siguiente)
+        self._siguiente = turno + self._intervalo
+        await asyncio.sleep(turno - ahora)
+
+ritmo = Ritmo(MENSAJES_POR_SEGUNDO)
+
+# Hace un envío respetando el ritmo. Si Telegram pide esperar, espera y lo vuelve a intentar.
+# Las esperas se miden aparte (fases 'ritmo' y 'reintento' de `handler`) para que no se
+# confundan con lo que tarda Telegram
+async def Envia_a_ritmo(envio, handler, intentos=3):
+    for intento in range(intentos):
+        with Tramo(handler, 'ritmo'):
+            await ritmo.espera()
+        try:
+            return await envio()
+        except(RetryAfter) as error:
+            if intento == intentos-1:
+                raise
+            logger.warning('Telegram pide esperar %s s', error.retry_after)
+            with Tramo(handler, 'reintento'):
+                await asyncio.sleep(error.retry_after)
+
+# Sin total: incluiría la espera del ritmo. Se miden el envío del texto y, en Manda_grafica,
+# la lectura y la subida de la gráfica
+async def Manda_configurado(bot, chat_id, datos, municipio, texto):
+
+    async def manda_texto():
+        with Tramo('programado', 'texto'):
+            return await bot.send_message(chat_id, texto)
+
+    try:
+        await Envia_a_ritmo(manda_texto, 'programado')
+        await Envia_a_ritmo(lambda: Manda_grafica(lambda foto: bot.send_photo(chat_id, foto), datos, municipio, 'programado'), 'programado')
+    except(Forbidden): # El usuario ha bloqueado el bot, lo damos de baja
+        logger.info('Chat %s ha bloqueado el bot, se elimina su suscripción', chat_id)
+        await asyncio.to_thread(suscripciones.desuscribe, chat_id)
+
+# Se ejecuta cada hora en punto y manda los datos a todos los suscritos a esa hora
+@Con_latencia('programado_lote')
+async def mandar_configurados(context):
+    hora = context.job.data
+
+    with Tramo('programado_lote', 'busqueda'):
+        por_municipio = await asyncio.to_thread(suscripciones.de_hora, hora)
+
+    datos = actual # Todo el lote con la misma instantánea
+
+    cola = asyncio.Queue()
+    for municipio, chats in por_municipio.items():
+        if municipio not in datos.almacen:
+            logger.warning('%s ya no está en los datos, no se manda a %d suscriptores', municipio, len(chats))
+            continue
+
+        texto = Texto_datos(datos.almacen.datos(municipio)) # Una vez por municipio
+        for chat_id in chats:
+            cola.put_nowait((chat_id, municipio, texto))
+
+    logger.info('Envío de las %d: %d suscriptores', hora, cola.qsize())
+
+    async def trabajador():
+        while True:
+            chat_id, municipio, texto = await cola.get()
+            try:
+                await Manda_configurado(context.bot, chat_id, datos, municipio, texto)
+            except Exception:
+                logger.exception('No se ha podido mandar %s al chat %s', municipio, chat_id)
+            finally:
+                cola.task_done()
+
+    trabajadores = [asyncio.create_task(trabajador()) for i in range(TRABAJADORES_ENVIO)]
+    await cola.join()
+    for tarea in trabajadores:
+        tarea.cancel()
+
+
+
+async def stats(update, context):
+    """Latencias del bot y tiempos de la última actualización, solo para los administradores."""
+
+    if update.message.chat_id not in ADMINS:
+        return
 
-    update.message.reply_text('Municipio desconfigurado correctamente')
-    """
+    lineas = ['Latencias del bot (s):']
+    for (nombre, etiquetas), histograma in sorted(metricas.histogramas().items()):
+        etiquetas = dict(etiquetas)
+        lineas.append('{}/{}: n={} media={:.3f} p50<={} p95<={}'.format(etiquetas['handler'], etiquetas['fase'], histograma.cuenta,
+                                                                       histograma.suma/histograma.cuenta, histograma.percentil(0.5), histograma.percentil(0.95)))
+
+    lineas.append('\nÚltima actualización de los datos:')
+    for nombre, etiquetas, valor in await asyncio.to_thread(LeeValores, METRICAS_UPDATER):
+        lineas.append('{}{{{}}}: {:.3f}'.format(nombre, etiquetas, valor))
+
+    await update.message.reply_text('\n'.join(lineas))
+
+
+# Cuenta cuántas veces se ha pedido cada municipio con /ver en los últimos `dias` días
+def Demanda(ruta, dias):
+    desde = (dt.datetime.now()-dt.timedelta(days=dias)).strftime('%Y-%m-%dT%H:%M:%S')
+
+    consultas = Counter()
+    try:
+        with open(ruta) as fin:
+            for linea in fin:
+                fecha, _, consulta = linea.rstrip('\n').partition(' ')
+                localidad, ventana = Lee_ventana(consulta.split()) # Sin los días o las fechas de la ventana
+                if fecha >= desde and localidad:
+                    consultas[' '.join(localidad).upper()] += 1
+    except(FileNotFoundError):
+        pass
+
+    demanda = Counter()
+    for consulta, veces in consultas.items():
+        municipios = Identifica_municipio(consulta)
+        if municipios:
+            demanda[municipios[0]] += veces
+    return demanda
+
+# Dibuja las gráficas de los municipios más pedidos para que estén en la caché
+async def precalienta(context):
+    demanda = await asyncio.to_thread(Demanda, './ver_history.txt', DIAS_DEMANDA)
+
+    for municipio, veces in demanda.most_common(PRECALENTAR):
+        async with subiendo[municipio]:
+            try:
+                await Grafica(actual, municipio, 'precalentar')
+            except Exception:
+                logger.exception('No se ha podido dibujar la gráfica de %s', municipio)
+
+
+# Carga la instantánea nueva si data_updater.py ha publicado otra. Los handlers que ya
+# han empezado terminan con la anterior y los siguientes usan la nueva. Las gráficas
+# de los municipios más pedidos se vuelven a dibujar, como al arrancar
+async def recarga(context):
+    global actual
+
+    directorio = await asyncio.to_thread(vigilante.cambiada)
+    if directorio is None:
+        return
 
-def mandar_configurado(context):
-    job = context.job
-    municipio = job.context['municipio']
-    chat_id = job.context['chat_id']
+    try:
+        with metricas.tramo('bot_recarga_segundos'):
+            nueva = await asyncio.to_thread(Instantanea, directorio)
+    except Exception:
+        logger.exception('No se ha podido cargar la instantánea %s', directorio)
+        return
 
-    with open('./Datos_municipios/{}/{}_data.json'.format(municipio, municipio)) as json_file:
-        data = json.load(json_file)
+    actual = nueva
+    vigilante.cargada(directorio)
+    logger.info('Cargada la instantánea %s con datos del %s', directorio, actual.almacen.fecha)
 
-        context.bot.send_message(chat_id, 'Datos de {} del {}:\n'
-                                          'Casos en el último día: {}\n'
-                                          'Casos en los últimos 15 días: {}\n'
-                                          'Casos acumulados desde el inicio: {}'.format(data['Municipio'], data['Fecha'], data['Datos']['CasosUltimoDia'], data['Datos']['Casos15dias'], data['Datos']['CasosAcum']))
+    context.job_queue.run_once(precalienta, 0)
 
-    context.bot.send_photo(chat_id, open('./Datos_municipios/{}/{}_plot.png'.format(municipio,municipio),'rb'))
 
+async def guarda_metricas(context):
+    await asyncio.to_thread(metricas.guarda, METRICAS)
 
 
 def main():
     """Start the bot."""
-    # Create the Updater and pass it your bot's token.
-    # Make sure to set use_context=True to use the new context based callbacks
-    # Post version 12 this will no longer be necessary
-    updater = Updater("TOKEN", use_context=True)
-    
+    from telegram.ext import Application, CommandHandler, CallbackQueryHandler, InlineQueryHandler # Solo hace falta para arrancar el bot
 
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
+    # Create the Application and pass it your bot's token.
+    # concurrent_updates permite atender varias peticiones a la vez
+    application = Application.builder().token("TOKEN").concurrent_updates(MAX_CONCURRENCIA).build()
 
     # on different commands - answer in Telegram
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CommandHandler("info", info))
-    dp.add_handler(CommandHandler("help", help_command))
-    dp.add_handler(
-        CommandHandler("ver", ver, pass_args=True)
-    )
-    dp.add_handler(CallbackQueryHandler(button))
-    dp.add_handler(
-        CommandHandler("configurar", configurar, pass_args=True, pass_chat_data=True)
-    )
-    dp.add_handler(CommandHandler("desconfigurar", desconfigurar, pass_chat_data=True))
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("info", info))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("ver", ver))
+    application.add_handler(CommandHandler("zona", zona))
+    application.add_handler(CommandHandler("ranking", ranking))
+    application.add_handler(CallbackQueryHandler(button_zona, pattern='^ZONA\\|'))
+    application.add_handler(CallbackQueryHandler(button))
+    application.add_handler(CommandHandler("configurar", configurar))
+    application.add_handler(CommandHandler("desconfigurar", desconfigurar))
+    application.add_handler(CommandHandler("stats", stats))
+    application.add_handler(InlineQueryHandler(inline))
+
+    # Un envío programado por cada hora del día
+    for hora in range(24):
+        application.job_queue.run_daily(mandar_configurados, dt.time(hour=hora, tzinfo=ZONA_HORARIA), data=hora, name='envio_{:02d}'.format(hora))
+
+    # Dibujamos las gráficas más pedidas por si no las ha dibujado data_updater.py
+    application.job_queue.run_once(precalienta, 0)
+
+    # Miramos si hay datos nuevos cada RECARGA segundos
+    application.job_queue.run_repeating(recarga, RECARGA)
+
+    # Exportamos las métricas cada minuto
+    application.job_queue.run_repeating(guarda_metricas, 60)
+
+    logger.info('%d suscripciones a envíos diarios', suscripciones.total())
 
     # on noncommand i.e message - echo the message on Telegram
-    #dp.add_handler(MessageHandler(Filters.text & ~Filters.command, echo))
-
-    # Start the Bot
-    updater.start_polling()
+    #application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    # SIGTERM or SIGABRT.
+    application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,215 @@
+"""
+Almacén binario con los datos de todos los municipios en un único archivo.
+
+data_updater.py lo escribe cada vez que procesa los datos y el bot lo abre una
+sola vez al arrancar con mmap, de forma que consultar un municipio es leer de
+memoria, sin abrir ni parsear ningún json.
+
+El formato es:
+    - 8 bytes con la firma b'CDNAVAL1'
+    - 4 bytes (uint32, little endian) con la longitud de la cabecera
+    - la cabecera en json (utf-8), rellenada con espacios hasta múltiplo de 8
+    - las tablas de enteros de 32 bits en el orden de bytes de la máquina que
+      lo escribe, una detrás de otra: 'Nuevos' y 'Acumulados' (filas x días)
+      y 'Resumen' (filas x 3, con Casos15dias, CasosUltimoDia y CasosAcum)
+      y, si hay zonas básicas, 'AcumuladosZonas' (zonas x días)
+
+'Acumulados' es la suma prefija de 'Nuevos' sobre todos los días (la primera
+columna es el día anterior al primer dato, con 0 casos), así que los casos de
+cualquier intervalo de días son la resta de dos valores: ver casos().
+
+La cabecera guarda la lista de filas (municipios y NAVARRA), la versión de la
+gráfica de cada fila, la fecha inicial, el número de días, la fecha de los
+datos, los municipios de cada zona básica y dónde empieza cada tabla. De las
+zonas solo se guardan los acumulados: sus cifras salen de ellos con casos().
+
+También guarda la población de cada fila, si se conoce, y el ranking de los
+municipios por casos en los últimos 15 días y por casos por 100.000
+habitantes, ya ordenado, para que ranking() solo tenga que cortarlo.
+"""
+
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+
+FIRMA = b'CDNAVAL1'
+RESUMEN = ['Casos15dias', 'CasosUltimoDia', 'CasosAcum']
+
+
+def Incidencia(casos, poblacion):
+    """Casos por 100.000 habitantes, con un decimal."""
+    return round(casos*100000/poblacion, 1)
+
+def Ranking(municipios, casos_15dias, poblacion):
+    """
+    Devuelve {métrica: [filas]} con las filas de los municipios (sin NAVARRA)
+    de más a menos casos en 15 días y de más a menos incidencia, solo con los
+    que tienen población. Los empates se ordenan por nombre.
+    """
+    filas = [fila for fila, municipio in enumerate(municipios) if municipio != 'NAVARRA']
+    return {'Casos15dias': sorted(filas, key=lambda fila: (-casos_15dias[fila], municipios[fila])),
+            'Incidencia15dias': sorted((fila for fila in filas if poblacion[fila] > 0),
+                                       key=lambda fila: (-Incidencia(casos_15dias[fila], poblacion[fila]), municipios[fila]))}
+
+
+def EscribeAlmacen(ruta, municipios, inicio, fecha, nuevos, acumulados, resumen, versiones=None, zonas=None, acumulados_zonas=None, poblacion=None):
+    """
+    Escribe el almacén en `ruta`. `nuevos` y `acumulados` son arrays de numpy
+    (filas x días) y `resumen` (filas x 3), con las filas en el mismo orden
+    que `municipios`. `inicio` es la fecha de la primera columna ('AAAA-MM-DD')
+    y `fecha` el texto con la fecha de los datos que se muestra al usuario.
+    `versiones` identifica la gráfica publicada de cada fila: si no cambia, la
+    gráfica tampoco. `zonas` es un diccionario {zona básica: [municipios]} y
+    `acumulados_zonas` (zonas x días) tiene las filas en el mismo orden.
+    `poblacion` es un diccionario {municipio: habitantes} (puede incluir
+    NAVARRA): los que no están no entran en el ranking por incidencia.
+    """
+    municipios = list(municipios)
+    if versiones is None:
+        versiones = ['']*len(municipios)
+    if zonas is None:
+        zonas = {}
+    if poblacion is None:
+        poblacion = {}
+
+    poblaciones = [int(poblacion.get(municipio, 0)) for municipio in municipios]
+
+    tablas = {'Nuevos': nuevos, 'Acumulados': acumulados, 'Resumen': resumen}
+    if zonas:
+        tablas['AcumuladosZonas'] = acumulados_zonas
+
+    cabecera = {'Municipios': municipios, 'Versiones': list(versiones), 'Inicio': inicio, 'Fecha': fecha,
+                'Dias': int(nuevos.shape[1]), 'Resumen': RESUMEN, 'Zonas': {zona: list(m) for zona, m in zonas.items()},
+                'Poblacion': poblaciones, 'Ranking': Ranking(municipios, [int(casos) for casos in resumen[:, 0]], poblaciones),
+                'Orden': sys.byteorder, 'Tablas': {}}
+
+    posicion = 0
+    for nombre, tabla in tablas.items(): # Las posiciones son relativas al final de la cabecera
+        cabecera['Tablas'][nombre] = [posicion, int(tabla.size)]
+        posicion += 4*int(tabla.size)
+
+    texto = json.dumps(cabecera).encode('utf-8')
+    texto += b' '*(-(len(FIRMA)+4+len(texto)) % 8)
+
+    with open(ruta+'.tmp', 'wb') as fout: # Escribimos aparte y renombramos para que nadie lea un almacén a medias
+        fout.write(FIRMA)
+        fout.write(struct.pack('<I', len(texto)))
+        fout.write(texto)
+        for tabla in tablas.values():
+            fout.write(tabla.astype('=i4').tobytes())
+
+    os.replace(ruta+'.tmp', ruta)
+
+
+class Almacen:
+    """
+    Lectura del almacén con mmap. Las tablas se exponen como memoryview de
+    enteros, así que no se copia nada a memoria hasta que se consulta.
+    """
+
+    def __init__(self, ruta):
+        with open(ruta, 'rb') as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(FIRMA)] != FIRMA:
+            raise ValueError('{} no es un almacén de COVIDataNav'.format(ruta))
+
+        longitud, = struct.unpack_from('<I', self._mmap, len(FIRMA))
+        comienzo = len(FIRMA)+4
+        cabecera = json.loads(self._mmap[comienzo:comienzo+longitud].decode('utf-8'))
+
+        if cabecera['Orden'] != sys.byteorder:
+            raise ValueError('{} se escribió en una máquina {} endian'.format(ruta, cabecera['Orden']))
+
+        self.municipios = cabecera['Municipios']
+        self.indice = {municipio: fila for fila, municipio in enumerate(self.municipios)}
+        self._versiones = cabecera['Versiones']
+        self.inicio = cabecera['Inicio']
+        self.fecha = cabecera['Fecha']
+        self.dias = cabecera['Dias']
+        self.resumen = cabecera['Resumen']
+        self.zonas = cabecera.get('Zonas', {}) # {zona básica: [municipios]}
+        self._indice_zonas = {zona: fila for fila, zona in enumerate(self.zonas)}
+        self.poblacion = cabecera.get('Poblacion', [0]*len(self.municipios)) # 0 si no se conoce
+        self._rankings = cabecera.get('Ranking', {})
+
+        memoria = memoryview(self._mmap)
+        self._tablas = {}
+        for nombre, (posicion, tamano) in cabecera['Tablas'].items():
+            inicio = comienzo+longitud+posicion
+            self._tablas[nombre] = memoria[inicio:inicio+4*tamano].cast('i')
+
+    def __contains__(self, municipio):
+        return municipio in self.indice
+
+    def _fila(self, tabla, municipio, columnas, indice=None):
+        fila = (self.indice if indice is None else indice)[municipio]
+        return self._tablas[tabla][fila*columnas:(fila+1)*columnas]
+
+    def _casos(self, acumulados, desde, hasta):
+        if hasta is None:
+            hasta = self.dias-1
+        desde = max(desde, 0)
+        hasta = min(hasta, self.dias-1)
+        if desde > hasta:
+            return 0
+        return acumulados[hasta] - (acumulados[desde-1] if desde > 0 else 0)
+
+    def version(self, municipio):
+        """Versión de la gráfica del municipio."""
+        return self._versiones[self.indice[municipio]]
+
+    def nuevos(self, municipio):
+        """Casos nuevos diarios del municipio, uno por día desde `inicio`."""
+        return self._fila('Nuevos', municipio, self.dias)
+
+    def acumulados(self, municipio):
+        """Casos acumulados del municipio, uno por día desde `inicio`."""
+        return self._fila('Acumulados', municipio, self.dias)
+
+    def columna(self, fecha):
+        """Columna de las tablas que corresponde a una fecha (datetime.date)."""
+        return (fecha-datetime.date.fromisoformat(self.inicio)).days
+
+    def casos(self, municipio, desde, hasta=None):
+        """
+        Casos nuevos del municipio entre las columnas `desde` y `hasta`, las dos
+        incluidas (por defecto hasta el último día). Se calcula con dos valores
+        de los acumulados, sin sumar los días.
+        """
+        return self._casos(self.acumulados(municipio), desde, hasta)
+
+    def datos(self, municipio):
+        """Devuelve lo mismo que el {municipio}_data.json del municipio."""
+        resumen = self._fila('Resumen', municipio, len(self.resumen))
+        return {'Municipio': municipio, 'Fecha': self.fecha, 'Datos': dict(zip(self.resumen, resumen.tolist()))}
+
+    def acumulados_zona(self, zona):
+        """Casos acumulados de la zona básica, uno por día desde `inicio`."""
+        return self._fila('AcumuladosZonas', zona, self.dias, self._indice_zonas)
+
+    def casos_zona(self, zona, desde, hasta=None):
+        """Como casos(), para una zona básica."""
+        return self._casos(self.acumulados_zona(zona), desde, hasta)
+
+    def datos_zona(self, zona):
+        """Devuelve las mismas cifras que datos() para una zona básica y sus municipios."""
+        acumulados = self.acumulados_zona(zona)
+        cifras = [self._casos(acumulados, self.dias-15, None), self._casos(acumulados, self.dias-1, None), acumulados[-1]]
+        return {'Zona': zona, 'Fecha': self.fecha, 'Datos': dict(zip(self.resumen, cifras)), 'Municipios': self.zonas[zona]}
+
+    def ranking(self, metrica='Casos15dias', n=10):
+        """
+        Los `n` primeros municipios por `metrica` ('Casos15dias' o
+        'Incidencia15dias') como [(municipio, valor)]. Vacío si el almacén no
+        tiene esa métrica (por ejemplo, la incidencia sin población).
+        """
+        primeros = []
+        for fila in self._rankings.get(metrica, [])[:n]:
+            casos = self._tablas['Resumen'][fila*len(self.resumen)]
+            valor = casos if metrica == 'Casos15dias' else Incidencia(casos, self.poblacion[fila])
+            primeros.append((self.municipios[fila], valor))
+        return primeros
@@ -0,0 +1,140 @@
+"""
+Benchmarks de data_updater.py y de la búsqueda de municipios con datos
+sintéticos (ver generador.py). No necesita conexión ni token de Telegram.
+
+Mide por separado cada etapa:
+    - carga: lectura y limpieza del csv (CargaDatos)
+    - carga_bloques: lo mismo leyendo el csv por bloques de `--bloque` filas
+    - agregacion: cubo (zona básica, municipio) x fecha y sus niveles: municipios,
+      Navarra y zonas básicas (MatrizCasos y TotalesZonas)
+    - json: escritura de los json de todos los municipios (GeneraDatos)
+    - graficas: dibujo de las gráficas de `--graficas` municipios (GeneraGrafica), por gráfica
+    - indice: construcción del índice de municipios (IndiceMunicipios)
+    - busqueda: identificación de municipios (IndiceMunicipios.identifica), por consulta
+
+y escribe el resultado en json (en la salida estándar o en --salida) junto
+con los parámetros y el commit, para poder comparar entre versiones.
+
+Uso: python benchmarks/bench.py --municipios 300 --zonas 60 --dias 250 --salida resultado.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIRECTORIO, '..'))
+sys.path.insert(0, DIRECTORIO)
+
+import data_updater
+from generador import GeneraCSV
+from indice_municipios import IndiceMunicipios
+
+
+def Commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIRECTORIO, capture_output=True, text=True, check=True).stdout.strip()
+    except(OSError, subprocess.CalledProcessError):
+        return None
+
+def Mide(funcion, repeticiones):
+    """Ejecuta la función `repeticiones` veces y devuelve el mejor tiempo y el último resultado."""
+    mejor = None
+    for i in range(repeticiones):
+        t0 = time.perf_counter()
+        resultado = funcion()
+        t = time.perf_counter()-t0
+        mejor = t if mejor is None else min(mejor, t)
+    return mejor, resultado
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks de data_updater.py y de la búsqueda de municipios.')
+    parser.add_argument('--municipios', type=int, default=300)
+    parser.add_argument('--zonas', type=int, default=60)
+    parser.add_argument('--dias', type=int, default=250)
+    parser.add_argument('--probabilidad', type=float, default=0.1)
+    parser.add_argument('--semilla', type=int, default=0)
+    parser.add_argument('--graficas', type=int, default=5, help='Número de gráficas que se dibujan')
+    parser.add_argument('--consultas', type=int, default=500, help='Número de búsquedas de municipios')
+    parser.add_argument('--bloque', type=int, default=10000, help='Filas por bloque en carga_bloques')
+    parser.add_argument('--repeticiones', type=int, default=3)
+    parser.add_argument('--salida', help='Archivo json en el que guardar el resultado')
+    args = parser.parse_args()
+
+    tiempos = {}
+
+    with tempfile.TemporaryDirectory() as directorio:
+        csv = os.path.join(directorio, 'CasosMunicipios_ZR_Covid.csv')
+        filas = GeneraCSV(csv, args.municipios, args.zonas, args.dias, args.probabilidad, args.semilla)
+
+        tiempos['carga'], df = Mide(lambda: data_updater.CargaDatos(csv), args.repeticiones)
+        tiempos['carga_bloques'], _ = Mide(lambda: data_updater.CargaDatos(csv, args.bloque), args.repeticiones)
+        def Agregacion():
+            nuevos, acumulados, cubo = data_updater.MatrizCasos(df)
+            return nuevos, acumulados, data_updater.TotalesZonas(cubo)
+        tiempos['agregacion'], (nuevos, acumulados, zonas) = Mide(Agregacion, args.repeticiones)
+
+        municipios = list(nuevos.index)
+
+        # GeneraDatos y GeneraGrafica escriben en ./Datos_municipios
+        anterior = os.getcwd()
+        os.chdir(directorio)
+        try:
+            for municipio in municipios:
+                os.makedirs('./Datos_municipios/{}'.format(municipio), exist_ok=True)
+
+            def Json():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for municipio in municipios:
+                        data_updater.GeneraDatos(nuevos.loc[municipio], acumulados.loc[municipio], municipio)
+            tiempos['json'], _ = Mide(Json, args.repeticiones)
+
+            dibujados = municipios[:args.graficas]
+            def Graficas():
+                for municipio in dibujados:
+                    data_updater.GeneraGrafica(municipio, nuevos.columns[0], nuevos.loc[municipio].to_numpy(), acumulados.loc[municipio].to_numpy())
+            if dibujados:
+                t, _ = Mide(Graficas, 1)
+                tiempos['graficas'] = t/len(dibujados)
+        finally:
+            os.chdir(anterior)
+
+    # Búsqueda de municipios: cada consulta es un nombre con una letra cambiada
+    t, indice = Mide(lambda: IndiceMunicipios(municipios), args.repeticiones)
+    tiempos['indice'] = t
+
+    aleatorio = random.Random(args.semilla)
+    consultas = []
+    for i in range(args.consultas):
+        nombre = aleatorio.choice(indice.alias)
+        posicion = aleatorio.randrange(len(nombre))
+        consultas.append(nombre[:posicion]+aleatorio.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ')+nombre[posicion+1:])
+
+    t, _ = Mide(lambda: [indice.identifica(consulta) for consulta in consultas], args.repeticiones)
+    tiempos['busqueda'] = t/len(consultas)
+
+    resultado = {
+        'commit': Commit(),
+        'python': platform.python_version(),
+        'parametros': {'municipios': args.municipios, 'zonas': args.zonas, 'dias': args.dias, 'probabilidad': args.probabilidad,
+                       'semilla': args.semilla, 'filas': filas, 'bloque': args.bloque, 'graficas': args.graficas, 'consultas': args.consultas},
+        'tiempos': tiempos, # En segundos; graficas y busqueda son por unidad
+    }
+
+    texto = json.dumps(resultado, indent=2)
+    if args.salida:
+        with open(args.salida, 'w') as fout:
+            fout.write(texto+'\n')
+    print(texto)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Micro-benchmark de la identificación de municipios.
+
+Compara IndiceMunicipios con la implementación anterior (get_close_matches
+sobre todos los alias y búsqueda de cada resultado en la lista de municipios)
+con las mismas consultas: cada alias, sus prefijos y versiones con erratas.
+Comprueba que las dos devuelven lo mismo y mide el tiempo medio por consulta.
+
+Uso: python benchmarks/bench_identifica.py [--repeticiones N]
+"""
+
+import argparse
+import csv
+import os
+import random
+import sys
+import timeit
+from difflib import get_close_matches
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from indice_municipios import IndiceMunicipios, Normaliza
+
+
+def CargaMunicipios(ruta):
+    """Lista de municipios del csv con los mismos filtros y nombres que data_updater.py."""
+    municipios = {'NAVARRA': None}
+    with open(ruta, encoding='latin-1') as fin:
+        for fila in csv.DictReader(fin, delimiter=';'):
+            if fila['CodZR'] in ('-1', '99') or fila['CodMun'] == '0':
+                continue
+            municipios[fila['DesMun'].replace(' / ', '_').replace('-', '_')] = None
+    return list(municipios)
+
+
+def Identifica_difflib(texto, alias, municipios):
+    """La búsqueda lineal de antes, con los nombres normalizados igual que el índice."""
+    normalizados = [Normaliza(municipio) for municipio in municipios]
+
+    mun_orig_cercanos = []
+    for cercano in get_close_matches(Normaliza(texto), alias):
+        for municipio, normalizado in zip(municipios, normalizados):
+            if cercano in normalizado and municipio not in mun_orig_cercanos:
+                mun_orig_cercanos.append(municipio)
+
+    return mun_orig_cercanos
+
+
+def Consultas(alias, semilla=0):
+    """Cada alias, su mitad inicial y una versión con una letra cambiada, en minúsculas."""
+    aleatorio = random.Random(semilla)
+    consultas = []
+    for a in alias:
+        consultas.append(a.lower())
+        consultas.append(a[:max(1, len(a)//2)].lower())
+        i = aleatorio.randrange(len(a))
+        consultas.append((a[:i]+aleatorio.choice('abcdefghijklmnopqrstuvwxyz')+a[i+1:]).lower())
+    return consultas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark de Identifica_municipio.')
+    parser.add_argument('--csv', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'CasosMunicipios_ZR_Covid.csv'))
+    parser.add_argument('--repeticiones', type=int, default=3)
+    args = parser.parse_args()
+
+    municipios = CargaMunicipios(args.csv)
+    indice = IndiceMunicipios(municipios)
+    consultas = Consultas(indice.alias)
+
+    distintas = [c for c in consultas if indice.identifica(c) != Identifica_difflib(c, indice.alias, municipios)]
+    if distintas:
+        print('Resultados distintos para {} consultas, por ejemplo: {}'.format(len(distintas), distintas[:5]))
+        sys.exit(1)
+
+    # La implementación anterior normalizaba los nombres fuera de la consulta
+    normalizados = [Normaliza(municipio) for municipio in municipios]
+    def Anterior():
+        for c in consultas:
+            for cercano in get_close_matches(Normaliza(c), indice.alias):
+                [m for m, n in zip(municipios, normalizados) if cercano in n]
+
+    def Indice():
+        for c in consultas:
+            indice.identifica(c)
+
+    t_anterior = min(timeit.repeat(Anterior, number=1, repeat=args.repeticiones))/len(consultas)
+    t_indice = min(timeit.repeat(Indice, number=1, repeat=args.repeticiones))/len(consultas)
+
+    print('{} municipios, {} alias, {} consultas con los mismos resultados'.format(len(municipios), len(indice.alias), len(consultas)))
+    print('get_close_matches: {:.1f} us/consulta'.format(t_anterior*1e6))
+    print('IndiceMunicipios:  {:.1f} us/consulta'.format(t_indice*1e6))
+    print('Aceleración: x{:.1f}'.format(t_anterior/t_indice))
+
+
+if __name__ == '__main__':
+    main()
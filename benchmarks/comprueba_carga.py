@@ -0,0 +1,84 @@
+"""
+Comprueba que la lectura del csv con tipos y categorías de data_updater.py
+(CargaDatos), entera y por bloques, da exactamente los mismos números que la
+lectura sin tipos que se usaba antes: mismos municipios, zonas y fechas y
+mismos casos nuevos y acumulados en cada uno.
+
+Se comprueba con un csv sintético (ver generador.py) y, si se pasa, con un
+csv real. Termina con código 1 si alguna comparación falla.
+
+Uso: python benchmarks/comprueba_carga.py [CasosMunicipios_ZR_Covid.csv] --bloque 1000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+import pandas as pd
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(DIRECTORIO, '..'))
+sys.path.insert(0, DIRECTORIO)
+
+import data_updater
+from generador import GeneraCSV
+
+
+def CargaDatosSinTipos(ruta):
+    """La lectura de antes: tipos inferidos, replace sobre todo el DataFrame y la fecha leída dos veces."""
+    df = pd.read_csv(ruta, encoding='latin-1', delimiter=';', parse_dates=[0])
+    df = df[df.CodZR != -1]
+    df = df[df.CodMun != 0]
+    df = df[df.CodZR != 99]
+    df = df.replace([' / ', '-'], '_', regex=True)
+    df.Fecha = pd.to_datetime(df.Fecha)
+    return df.set_index('Fecha')
+
+def Niveles(df):
+    nuevos, acumulados, cubo = data_updater.MatrizCasos(df)
+    acumulados_zonas, zonas = data_updater.TotalesZonas(cubo)
+    return {'nuevos': nuevos, 'acumulados': acumulados, 'acumulados_zonas': acumulados_zonas, 'zonas': zonas}
+
+def Compara(nombre, referencia, resultado):
+    """Devuelve True si los dos resultados de Niveles son idénticos, valor a valor."""
+    bien = True
+    for clave, esperado in referencia.items():
+        obtenido = resultado[clave]
+        if isinstance(esperado, pd.DataFrame):
+            igual = (list(esperado.index) == list(obtenido.index) and list(esperado.columns) == list(obtenido.columns)
+                     and (esperado.to_numpy() == obtenido.to_numpy()).all())
+        else:
+            igual = esperado == obtenido
+        if not igual:
+            print('{}: {} distinto'.format(nombre, clave))
+            bien = False
+    print('{}: {}'.format(nombre, 'igual' if bien else 'DISTINTO'))
+    return bien
+
+def Comprueba(ruta, bloque):
+    referencia = Niveles(CargaDatosSinTipos(ruta))
+    bien = Compara('{} entero'.format(os.path.basename(ruta)), referencia, Niveles(data_updater.CargaDatos(ruta)))
+    bien &= Compara('{} por bloques de {}'.format(os.path.basename(ruta), bloque), referencia, Niveles(data_updater.CargaDatos(ruta, bloque)))
+    return bien
+
+def main():
+    parser = argparse.ArgumentParser(description='Comprueba que CargaDatos da los mismos números que la lectura sin tipos.')
+    parser.add_argument('csv', nargs='?', help='csv real con el que comprobar además del sintético')
+    parser.add_argument('--bloque', type=int, default=1000, help='Filas por bloque en la lectura por bloques')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directorio:
+        sintetico = os.path.join(directorio, 'sintetico.csv')
+        GeneraCSV(sintetico, semilla=args.semilla)
+        bien = Comprueba(sintetico, args.bloque)
+
+    if args.csv:
+        bien &= Comprueba(args.csv, args.bloque)
+
+    sys.exit(0 if bien else 1)
+
+
+if __name__ == '__main__':
+    main()
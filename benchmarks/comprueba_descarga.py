@@ -0,0 +1,124 @@
+"""
+Comprueba la descarga condicional de data_downloader.py (Descarga) contra un
+servidor http.server local que hace de servidor del Gobierno de Navarra:
+
+- primera descarga (200): se guarda el archivo y el estado con ETag y SHA-256
+- mismo ETag (304): no se descarga nada
+- el servidor no responde 304 pero el archivo es el mismo: se descarta
+- archivo nuevo (200): se sustituye el anterior
+- si la actualización falla (no se llama a Procesado), la siguiente ejecución
+  lo vuelve a dar como nuevo aunque el servidor responda 304
+
+Termina con código 1 si alguna comprobación falla.
+
+Uso: python benchmarks/comprueba_descarga.py
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import data_downloader
+
+ULTIMA_MODIFICACION = 'Tue, 13 Oct 2020 08:00:00 GMT'
+
+
+class Servidor(BaseHTTPRequestHandler):
+    """Sirve `contenido` con ETag y Last-Modified y, si `condicional`, responde 304 cuando no ha cambiado."""
+
+    contenido = b''
+    condicional = True
+    peticiones = []
+
+    def do_GET(self):
+        etag = '"{}"'.format(hashlib.sha256(self.contenido).hexdigest()[:16])
+        Servidor.peticiones.append(dict(self.headers))
+
+        if self.condicional and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.contenido)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', ULTIMA_MODIFICACION)
+        self.end_headers()
+        self.wfile.write(self.contenido)
+
+    def log_message(self, *args):
+        pass
+
+
+def Comprueba(nombre, condicion):
+    print('{}: {}'.format(nombre, 'bien' if condicion else 'MAL'))
+    return condicion
+
+def LeeArchivo(ruta):
+    with open(ruta, 'rb') as fin:
+        return fin.read()
+
+def main():
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Servidor)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/CasosMunicipios_ZR_Covid.csv'.format(servidor.server_address[1])
+
+    csv = 'Fecha;CodZR;DesZR;CodMun;DesMun;NuevosCasos;AcumuladoCasosHastaLaFecha\n'.encode('latin-1')
+    primero = csv + '2020-10-12 00:00:00;18;CHANTREA;747;PAMPLONA / IRUÑA;1;1\n'.encode('latin-1')
+    segundo = primero + '2020-10-13 00:00:00;18;CHANTREA;747;PAMPLONA / IRUÑA;2;3\n'.encode('latin-1')
+
+    bien = True
+    with tempfile.TemporaryDirectory() as directorio:
+        destino = os.path.join(directorio, data_downloader.CSV)
+        ruta_estado = os.path.join(directorio, 'descarga_estado.json')
+
+        def Descarga():
+            return data_downloader.Descarga(url, destino, ruta_estado, timeout=10)
+
+        def Procesado():
+            data_downloader.Procesado(ruta_estado)
+
+        def Estado():
+            with open(ruta_estado) as fin:
+                return json.load(fin)
+
+        # Primera descarga
+        Servidor.contenido = primero
+        bien &= Comprueba('200 primera descarga', Descarga() and LeeArchivo(destino) == primero
+                          and Estado().get('SHA256') == hashlib.sha256(primero).hexdigest() and 'ETag' in Estado())
+        Procesado()
+
+        # Mismo ETag: el servidor responde 304
+        Servidor.peticiones.clear()
+        bien &= Comprueba('304 sin cambios', not Descarga() and LeeArchivo(destino) == primero
+                          and Servidor.peticiones[-1].get('If-None-Match') == Estado()['ETag']
+                          and Servidor.peticiones[-1].get('If-Modified-Since') == ULTIMA_MODIFICACION)
+
+        # El servidor no hace caso de las cabeceras pero manda el mismo archivo
+        Servidor.condicional = False
+        bien &= Comprueba('200 mismo SHA-256', not Descarga() and LeeArchivo(destino) == primero
+                          and not os.path.exists(destino+'.part'))
+
+        # Archivo nuevo
+        Servidor.condicional = True
+        Servidor.contenido = segundo
+        bien &= Comprueba('200 archivo nuevo', Descarga() and LeeArchivo(destino) == segundo
+                          and Estado().get('SHA256') == hashlib.sha256(segundo).hexdigest())
+
+        # La actualización ha fallado: hasta que se procese se sigue dando como nuevo
+        bien &= Comprueba('304 con la actualización pendiente', Descarga() and LeeArchivo(destino) == segundo)
+        Procesado()
+        bien &= Comprueba('304 ya procesado', not Descarga())
+
+    servidor.shutdown()
+    sys.exit(0 if bien else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Generador de csv sintéticos con el mismo formato que CasosMunicipios_ZR_Covid.csv
+(separado por ';', codificado en latin-1 y con las mismas columnas) para medir
+cómo escalan data_updater.py y la búsqueda de municipios.
+
+Cada municipio pertenece a una zona básica y algunos, como Pamplona, a
+varias. Cada día, cada par (zona, municipio) tiene casos con probabilidad
+`probabilidad`. Además se añaden filas de Nulo/Sin informar, de otras
+Comunidades Autónomas y de la zona 99 para que se ejerciten los filtros.
+
+Uso: python benchmarks/generador.py salida.csv --municipios 300 --zonas 60 --dias 250
+"""
+
+import argparse
+import datetime
+import random
+
+COLUMNAS = 'Fecha;CodZR;DesZR;CodMun;DesMun;NuevosCasos;AcumuladoCasosHastaLaFecha'
+
+SILABAS = ['A', 'BE', 'CA', 'DO', 'E', 'GA', 'I', 'LA', 'MU', 'NA', 'O', 'PE', 'RI', 'SA', 'TU', 'U', 'ZA', 'ÑA', 'TX', 'KO', 'RRE', 'BAR', 'GOI', 'ITZ']
+
+
+def Nombre(aleatorio, usados):
+    while True:
+        nombre = ''.join(aleatorio.choice(SILABAS) for i in range(aleatorio.randint(2, 5)))
+        if nombre not in usados:
+            usados.add(nombre)
+            return nombre
+
+def Municipios(aleatorio, n):
+    """Nombres de municipios, algunos en formato CASTELLANO / EUSKERA o CASTELLANO-EUSKERA."""
+    usados = set()
+    municipios = []
+    for i in range(n):
+        nombre = Nombre(aleatorio, usados)
+        forma = aleatorio.random()
+        if forma < 0.2:
+            nombre += ' / ' + Nombre(aleatorio, usados)
+        elif forma < 0.25:
+            nombre += '-' + Nombre(aleatorio, usados)
+        elif forma < 0.35:
+            nombre += ' DE ' + Nombre(aleatorio, usados)
+        municipios.append(nombre)
+    return municipios
+
+def GeneraCSV(ruta, municipios=300, zonas=60, dias=250, probabilidad=0.1, semilla=0):
+    """Escribe el csv sintético en `ruta` y devuelve el número de filas."""
+    aleatorio = random.Random(semilla)
+
+    nombres = Municipios(aleatorio, municipios)
+    usados = set(nombres)
+    nombres_zonas = [Nombre(aleatorio, usados) for i in range(zonas)]
+
+    # Cada municipio en una zona (codigo 1..zonas) y el primero repartido en varias, como Pamplona
+    pares = [(1+aleatorio.randrange(zonas), 1+i) for i in range(municipios)]
+    pares += [(1+z, 1) for z in aleatorio.sample(range(zonas), min(zonas, 10))]
+    pares = sorted(set(pares))
+
+    acumulados = {}
+    filas = 0
+    inicio = datetime.date(2020, 2, 28)
+
+    with open(ruta, 'w', encoding='latin-1', newline='') as fout:
+        fout.write(COLUMNAS+'\n')
+
+        for dia in range(dias):
+            fecha = (inicio+datetime.timedelta(days=dia)).strftime('%Y-%m-%d 00:00:00')
+
+            for cod_zr, cod_mun in pares:
+                if aleatorio.random() < probabilidad:
+                    casos = 1+int(aleatorio.expovariate(0.5))
+                    acumulados[(cod_zr, cod_mun)] = acumulados.get((cod_zr, cod_mun), 0)+casos
+                    fout.write('{};{};{};{};{};{};{}\n'.format(fecha, cod_zr, nombres_zonas[cod_zr-1], cod_mun, nombres[cod_mun-1], casos, acumulados[(cod_zr, cod_mun)]))
+                    filas += 1
+
+            # Filas que data_updater.py tiene que descartar
+            for cod_zr, des_zr, cod_mun, des_mun in [(-1, 'Nulo/Sin informar', -1, 'Nulo/Sin informar'), (99, 'FUERA DE NAVARRA', 0, 'Fuera de Navarra'), (99, 'LIMITROFE', 5009, 'LIMITROFE')]:
+                if aleatorio.random() < 0.5:
+                    fout.write('{};{};{};{};{};{};{}\n'.format(fecha, cod_zr, des_zr, cod_mun, des_mun, 1, 1))
+                    filas += 1
+
+    return filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Genera un csv sintético con el formato de CasosMunicipios_ZR_Covid.csv.')
+    parser.add_argument('salida')
+    parser.add_argument('--municipios', type=int, default=300)
+    parser.add_argument('--zonas', type=int, default=60)
+    parser.add_argument('--dias', type=int, default=250)
+    parser.add_argument('--probabilidad', type=float, default=0.1, help='Probabilidad de que un municipio tenga casos un día')
+    parser.add_argument('--semilla', type=int, default=0)
+    args = parser.parse_args()
+
+    filas = GeneraCSV(args.salida, args.municipios, args.zonas, args.dias, args.probabilidad, args.semilla)
+    print('{} filas escritas en {}'.format(filas, args.salida))
+
+
+if __name__ == '__main__':
+    main()
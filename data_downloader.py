@@ -4,27 +4,138 @@ http://www.navarra.es/appsext/DescargarFichero/default.aspx?codigoAcceso=OpenDat
 y combrueba si están actualizados con
 respecto a los descargados previamente.
 Si son nuevos renombra el archivo y
-llama a data_updater.py, si no lo elimina.
+actualiza los datos con data_updater.py, si no lo elimina.
 
-Version 1.0
+La descarga es condicional: se manda el ETag y la fecha de modificación de la
+última descarga y si el servidor responde que no ha cambiado (304) no se
+descarga nada. Si hay que descargarlo se va calculando el SHA-256 mientras se
+escribe y se compara con el del último archivo publicado, que se guarda junto
+con el ETag en descarga_estado.json. El archivo nuevo sustituye al anterior con
+un renombrado atómico.
+
+Hasta que data_updater.py no procesa el archivo nuevo sin errores el estado lo
+marca como pendiente, así que si la actualización falla se vuelve a intentar en
+la siguiente ejecución aunque el servidor responda que no ha cambiado.
+
+Con --url se puede descargar de otra dirección, por ejemplo de un servidor
+local para hacer pruebas.
+
+Version 1.1
 Daniel Enériz Orta
 
 """
 
 
-import urllib.request
+import argparse
+import hashlib
+import json
 import os
+import urllib.error
+import urllib.request
+
+URL = r'http://www.navarra.es/appsext/DescargarFichero/default.aspx?codigoAcceso=OpenData&fichero=coronavirus\CasosMunicipios_ZR_Covid.csv'
+CSV = 'CasosMunicipios_ZR_Covid.csv'
+ESTADO = './descarga_estado.json'
+
+TAMANO_BLOQUE = 64*1024
+
+
+def Sha256(ruta):
+    sha256 = hashlib.sha256()
+    with open(ruta, 'rb') as fin:
+        for bloque in iter(lambda: fin.read(TAMANO_BLOQUE), b''):
+            sha256.update(bloque)
+    return sha256.hexdigest()
+
+def CargaEstado(ruta, destino):
+    try:
+        with open(ruta) as json_file:
+            return json.load(json_file)
+    except(FileNotFoundError):
+        pass
+
+    # La primera vez calculamos el SHA-256 del archivo que ya tenemos, si lo hay
+    if os.path.exists(destino):
+        return {'SHA256': Sha256(destino)}
+    return {}
+
+def GuardaEstado(ruta, estado):
+    with open(ruta+'.tmp', 'w') as json_fout:
+        json.dump(estado, json_fout)
+    os.replace(ruta+'.tmp', ruta)
+
+def Descarga(url=URL, destino=CSV, ruta_estado=ESTADO, timeout=60):
+    """
+    Descarga `url` en `destino` solo si ha cambiado. Devuelve True si el
+    archivo se ha actualizado o si todavía no se ha procesado la última
+    actualización (ver Procesado) y False si no.
+    """
+    estado = CargaEstado(ruta_estado, destino)
+
+    peticion = urllib.request.Request(url)
+    if 'ETag' in estado:
+        peticion.add_header('If-None-Match', estado['ETag'])
+    if 'Last-Modified' in estado:
+        peticion.add_header('If-Modified-Since', estado['Last-Modified'])
+
+    try:
+        respuesta = urllib.request.urlopen(peticion, timeout=timeout)
+    except(urllib.error.HTTPError) as error:
+        if error.code == 304:
+            print('Los datos no han cambiado (304)')
+            return estado.get('Pendiente', False)
+        raise
+
+    temporal = destino+'.part' # En el mismo directorio para que el renombrado sea atómico
+    sha256 = hashlib.sha256()
+
+    try:
+        with respuesta, open(temporal, 'wb') as fout:
+            for bloque in iter(lambda: respuesta.read(TAMANO_BLOQUE), b''):
+                sha256.update(bloque)
+                fout.write(bloque)
+
+            for cabecera in ('ETag', 'Last-Modified'): # Nos quedamos con las cabeceras para la próxima vez
+                if respuesta.headers.get(cabecera) is not None:
+                    estado[cabecera] = respuesta.headers[cabecera]
+                else:
+                    estado.pop(cabecera, None)
+    except BaseException:
+        os.remove(temporal)
+        raise
+
+    actualizado = sha256.hexdigest() != estado.get('SHA256')
+
+    if actualizado:
+        print('Actualización de datos, sustituyendo el archivo csv')
+        os.replace(temporal, destino)
+        estado['SHA256'] = sha256.hexdigest()
+        estado['Pendiente'] = True
+    else:
+        print('Los datos descargados son iguales a los anteriores')
+        os.remove(temporal)
+
+    GuardaEstado(ruta_estado, estado)
+
+    return estado.get('Pendiente', False)
+
+def Procesado(ruta_estado=ESTADO):
+    """Marca el archivo descargado como procesado, una vez que data_updater.py ha terminado sin errores."""
+    with open(ruta_estado) as json_file:
+        estado = json.load(json_file)
+    estado.pop('Pendiente', None)
+    GuardaEstado(ruta_estado, estado)
 
-url = 'http://www.navarra.es/appsext/DescargarFichero/default.aspx?codigoAcceso=OpenData&fichero=coronavirus\CasosMunicipios_ZR_Covid.csv'
-urllib.request.urlretrieve(url, 'CasosMunicipios_ZR_Covid_new.csv')
+def main():
+    parser = argparse.ArgumentParser(description='Descarga los datos y, si han cambiado, los actualiza.')
+    parser.add_argument('--url', default=URL, help='Dirección de la que descargar el csv')
+    args = parser.parse_args()
 
-comparador = os.system('FC /A CasosMunicipios_ZR_Covid_new.csv CasosMunicipios_ZR_Covid.csv')
+    if Descarga(args.url):
+        import data_updater # Solo hace falta (y es lento de importar) si hay datos nuevos
+        data_updater.main([])
+        Procesado()
 
-if comparador: #Abrá que adaptarlo a la consola en linux
-    print('Actualización de datos, borrando viejo y renombrando archivo csv')
-    os.remove('CasosMunicipios_ZR_Covid.csv')
-    os.rename('CasosMunicipios_ZR_Covid_new.csv', 'CasosMunicipios_ZR_Covid.csv')
 
-    os.system('python data_updater.py')
-else:
-    os.remove('CasosMunicipios_ZR_Covid_new.csv')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -5,122 +5,429 @@ casos positivos en el último día, en los últimos 15 días y los acumulados de
 el incio de la pandemia para esa localidad. Además se genera una gráfica con
 la evolución de la pandemia en esa localidad.
 
+Las gráficas se generan en paralelo en un conjunto de procesos. El número de
+procesos se elige con --procesos (por defecto, uno por núcleo).
+
+Para no repetir trabajo se guarda en estado_updater.json una huella de cada
+municipio (los días con casos) junto con la última fecha procesada. La gráfica
+de un municipio termina en su último día con casos y no lleva la fecha de los
+datos (el bot la manda en el texto), así que solo se vuelven a dibujar las de
+los municipios cuya huella ha cambiado. Los json llevan la fecha, así que se
+reescriben todos cuando hay un día nuevo. Con --full se regenera todo.
+
+Además se escriben todos los datos en un único archivo binario,
+Datos_municipios.bin (ver almacen.py), que es el que lee el bot.
+
+Junto al almacén se escribe Manifiesto.json con los índices de nombres de los
+municipios y de las zonas ya construidos, que el bot carga al arrancar (ver
+indice_municipios.py).
+
+El almacén, el manifiesto y las gráficas se publican juntos en una instantánea
+nueva dentro de Publicado/ y, cuando está completa, se cambia el puntero a la
+instantánea actual de una vez (ver publicacion.py). El bot la carga sin
+reiniciarse. Los json y las gráficas de Datos_municipios se escriben aparte y
+se renombran, así que nunca se leen a medias.
+
+El almacén lleva también el ranking de los municipios por casos en los últimos
+15 días y, si existe Poblacion_municipios.csv, por casos por 100.000 habitantes.
+
+Con --bajo-demanda no se dibuja ninguna gráfica y se borran las de los municipios
+que han cambiado: el bot las dibuja cuando se piden (ver graficas.py).
+
+El csv se lee con los tipos de cada columna fijados (las zonas y los municipios
+como categorías) y, con --bloque, por bloques de filas que se filtran según se
+leen, de forma que solo se guarda en memoria lo que se va a usar.
+
+Lo que tarda cada etapa (lectura del csv, filtrado, agregación, json, gráficas
+y savefig de cada municipio) se guarda en formato Prometheus en
+metricas_updater.prom (ver metricas.py).
+
 Además hace lo mismo para toda Navarra
 
 Se descartan todos los casos nulos (sin información de localdiad) y los de Fuera de Navarra.
 
-Version 1.1
+Version 1.2
 Daniel Enériz Orta
 """
 
 
+import argparse
+import concurrent.futures
+import matplotlib
+matplotlib.use('Agg') # Sin interfaz gráfica, así se puede dibujar desde varios procesos
 import pandas as pd
+from pandas.api.types import union_categoricals
 import matplotlib.pyplot as plt
 import time
 import datetime
+import hashlib
+import io
 import json
 import os
 import locale
 
-def GeneraDatos(dfmun_tot, municipio):
-        #Calculammos los confirmados en los últimos 15 días, los casos en el último día y los acumulados hasta hoy
-    casos_15dias = int(dfmun_tot.last('15D').NuevosCasos.sum())
+from almacen import EscribeAlmacen
+from indice_municipios import EscribeManifiesto
+import publicacion
+from metricas import metricas
+
+LOCALE = 'es_ES'
+
+CSV = 'CasosMunicipios_ZR_Covid.csv'
+
+ESTADO = './estado_updater.json'
+METRICAS = './metricas_updater.prom'
+POBLACION = './Poblacion_municipios.csv' # Opcional: Municipio;Poblacion, en latin-1 como el de casos
+
+# Tipos de las columnas del csv. Las zonas y los municipios son categorías: cada
+# nombre se guarda una sola vez y las filas solo llevan su código
+TIPOS = {'CodZR': 'int16', 'DesZR': 'category', 'CodMun': 'int16', 'DesMun': 'category',
+         'NuevosCasos': 'int32', 'AcumuladoCasosHastaLaFecha': 'int32'}
+COLUMNAS = ['Fecha', 'DesZR', 'DesMun', 'NuevosCasos'] # Las que se usan después de filtrar
+
+def FiltraDatos(df):
+    """Quita las filas que no corresponden a ningún municipio navarro y deja solo COLUMNAS."""
+    df = df[(df.CodZR != -1)    #Eliminamos los datos Nulos/Sin informar
+            & (df.CodMun != 0)  #Eliminamos los datos de positivos de otras Comunidades Autónomas
+            & (df.CodZR != 99)]
+    return df[COLUMNAS]
+
+def NormalizaNombres(columna):
+    """
+    Renombra los nombres en formato CASTELLANO / EUSKERA y CASTELLANO-EUSKERA
+    como CASTELLANO_EUSKERA para poder usarlos para crear directorios. Se
+    cambian las categorías, no cada fila.
+    """
+    columna = columna.cat.remove_unused_categories()
+    nombres = columna.cat.categories.str.replace(' / ', '_', regex=False).str.replace('-', '_', regex=False)
+    if nombres.is_unique:
+        return columna.cat.rename_categories(nombres)
+    return pd.Series(nombres[columna.cat.codes], index=columna.index, dtype='category') # Dos nombres distintos quedan iguales
+
+def CargaDatos(ruta, bloque=None):
+    """
+    Lee el csv, quita las filas que no corresponden a ningún municipio navarro
+    y devuelve los datos con la fecha como índice. Con `bloque` se lee el csv
+    de `bloque` en `bloque` filas, filtrando cada bloque según se lee.
+    """
+    with metricas.tramo('updater_etapa_segundos', etapa='lectura'):
+        lector = pd.read_csv(ruta, encoding='latin-1', delimiter=';', dtype=TIPOS, parse_dates=['Fecha'], chunksize=bloque) # Cargamos datos
+
+        if bloque is None:
+            df = FiltraDatos(lector)
+        else:
+            bloques = [FiltraDatos(parte) for parte in lector]
+            for columna in ('DesZR', 'DesMun'): # Cada bloque tiene sus propias categorías
+                categorias = union_categoricals([parte[columna] for parte in bloques], sort_categories=True).categories
+                bloques = [parte.astype({columna: pd.CategoricalDtype(categorias)}) for parte in bloques]
+            df = pd.concat(bloques, ignore_index=True)
+
+    with metricas.tramo('updater_etapa_segundos', etapa='filtrado'):
+        df = df.assign(DesZR=NormalizaNombres(df.DesZR), DesMun=NormalizaNombres(df.DesMun))
+        df = df.set_index('Fecha') # Usamos la fecha como ínidce
+
+    return df
+
+def CargaPoblacion(ruta):
+    """
+    Lee la población de cada municipio como {municipio: habitantes}, con los
+    nombres como en CargaDatos. Si no existe el archivo devuelve {}.
+    """
+    try:
+        df = pd.read_csv(ruta, encoding='latin-1', delimiter=';', dtype={'Municipio': 'str', 'Poblacion': 'int64'})
+    except(FileNotFoundError):
+        return {}
+
+    nombres = df.Municipio.str.replace(' / ', '_', regex=False).str.replace('-', '_', regex=False)
+    return dict(zip(nombres, df.Poblacion))
+
+def MatrizCasos(df):
+    """
+    Construye en una sola pasada el cubo (zona básica, municipio) x fecha con
+    los nuevos casos diarios, que es el nivel más fino de los datos. Los demás
+    niveles salen de él sin volver a agrupar el csv: la matriz municipio x
+    fecha, con una fila NAVARRA con el total, y la de casos acumulados.
+    Devuelve los nuevos, los acumulados y el cubo (para TotalesZonas).
+
+    Las fechas empiezan el día anterior al primer dato (con 0 casos) para que
+    las gráficas arranquen desde cero.
+    """
+    fechas = pd.date_range(start=df.index.min()-datetime.timedelta(days=1), end=df.index.max(), freq='D')
+
+    cubo = df.groupby(['DesZR', 'DesMun', 'Fecha'], observed=True).NuevosCasos.sum().unstack(fill_value=0) # Agrupamos una sola vez por zona, municipio y fecha
+    cubo = cubo.reindex(columns=fechas, fill_value=0)                                                         # y rellenamos los días sin casos
+
+    # Los nombres de las filas pasan a ser texto, en orden alfabético se lea el csv entero o por bloques
+    cubo.index = cubo.index.set_levels([nivel.astype(object) for nivel in cubo.index.levels], level=[0, 1])
+    cubo = cubo.sort_index()
+
+    nuevos = cubo.groupby(level='DesMun').sum() # Un municipio puede estar en varias zonas (Pamplona en 14)
+    nuevos.loc['NAVARRA'] = cubo.sum()          # El total de Navarra es la suma de todo el cubo
+
+    acumulados = nuevos.cumsum(axis=1)
+
+    return nuevos, acumulados, cubo
+
+def TotalesZonas(cubo):
+    """
+    Devuelve la matriz zona básica x fecha de casos acumulados, sumando el
+    cubo de MatrizCasos, y los municipios de cada zona como {zona: [municipios]}.
+    """
+    acumulados = cubo.groupby(level='DesZR').sum().cumsum(axis=1)
+    municipios = {zona: list(cubo.loc[zona].index) for zona in acumulados.index}
+    return acumulados, municipios
+
+def HuellasMunicipios(nuevos):
+    """
+    Calcula una huella (sha256) para cada fila de la matriz de nuevos casos a
+    partir de los días con casos. La gráfica solo depende de ellos (ver
+    GeneraGrafica) y, con la misma fecha, los datos del json tampoco cambian si
+    no cambia la huella.
+    """
+    fechas = nuevos.columns.strftime('%Y-%m-%d')
+    huellas = {}
+
+    for municipio, serie in zip(nuevos.index, nuevos.to_numpy()):
+        con_casos = serie.nonzero()[0]
+        historia = [[fechas[i], int(serie[i])] for i in con_casos]
+
+        huellas[municipio] = hashlib.sha256(json.dumps(historia).encode()).hexdigest()
+
+    return huellas
+
+def CargaEstado():
+    try:
+        with open(ESTADO) as json_file:
+            return json.load(json_file)
+    except(FileNotFoundError):
+        return {}
+
+def GuardaEstado(estado):
+    with open(ESTADO+'.tmp', 'w') as json_fout: # Escribimos aparte y renombramos para no dejar el estado a medias
+        json.dump(estado, json_fout)
+    os.replace(ESTADO+'.tmp', ESTADO)
 
-    casos_ultimodia = int(dfmun_tot.last('1D').NuevosCasos.sum())
+def GeneraDatos(nuevos, acumulados, municipio):
+    #Calculammos los confirmados en los últimos 15 días, los casos en el último día y los acumulados hasta hoy
+    casos_15dias = int(nuevos.iloc[-15:].sum())
 
-    acumulados_hasta_hoy = int(dfmun_tot.last('1D').AcumuladoCasosHastaLaFecha.sum())
+    casos_ultimodia = int(nuevos.iloc[-1])
 
-    datos_municipio = {'Municipio': municipio, 'Fecha': df.last('1D').index[0].strftime('%d de %B de %Y'), 'Datos':{'Casos15dias': casos_15dias, 'CasosUltimoDia': casos_ultimodia, 'CasosAcum': acumulados_hasta_hoy}}
+    acumulados_hasta_hoy = int(acumulados.iloc[-1])
 
-    with open('./Datos_municipios/{}/{}_data.json'.format(municipio, municipio), 'w') as json_fout:
+    datos_municipio = {'Municipio': municipio, 'Fecha': nuevos.index[-1].strftime('%d de %B de %Y'), 'Datos':{'Casos15dias': casos_15dias, 'CasosUltimoDia': casos_ultimodia, 'CasosAcum': acumulados_hasta_hoy}}
+
+    ruta = './Datos_municipios/{}/{}_data.json'.format(municipio, municipio)
+    with open(ruta+'.tmp', 'w') as json_fout: # Se escribe aparte y se renombra para que nadie lea un json a medias
         json.dump(datos_municipio, json_fout)
+    os.replace(ruta+'.tmp', ruta)
 
     print('{}:\n\tÚltimo día: {}\n\t15 días: {}\n\tAcumulados: {}'.format(municipio, casos_ultimodia, casos_15dias, acumulados_hasta_hoy))
 
+def GeneraGrafica(municipio, inicio, nuevos, acumulados, destino=None):
+    """
+    Dibuja y guarda la gráfica de un municipio. Solo recibe la fecha inicial y
+    los arrays de casos nuevos y acumulados para que mandarla a otro proceso
+    sea barato. La gráfica termina en el último día con casos del municipio y
+    no lleva la fecha de los datos, así que no cambia mientras no haya casos
+    nuevos (ver HuellasMunicipios). Se guarda en `destino` (una ruta o un archivo abierto) o, por
+    defecto, en el directorio del municipio, escribiéndola aparte y
+    renombrándola: así quien la lea (o una instantánea que la enlace) ve la
+    vieja o la nueva, nunca una a medias. Devuelve lo que ha tardado en total
+    y lo que ha tardado savefig.
+    """
+    ruta = None
+    if destino is None:
+        ruta = './Datos_municipios/{}/{}_plot.png'.format(municipio, municipio)
+        destino = ruta+'.tmp'
+
+    t0 = time.perf_counter()
+
+    # Cortamos los días sin casos del final
+    dias = next((i+1 for i in range(len(nuevos)-1, -1, -1) if nuevos[i] != 0), len(nuevos))
+    nuevos, acumulados = nuevos[:dias], acumulados[:dias]
+
+    fechas = pd.date_range(start=inicio, periods=dias, freq='D')
+
     fig, ax2 = plt.subplots()
 
     ax1 = ax2.twinx();  # instantiate a second axes that shares the same x-axis
 
     ax2.set_ylabel('Nuevos casos diarios')  # we already handled the x-label with ax1
-    ax2.fill_between(dfmun_tot.index, dfmun_tot.NuevosCasos, color='C1', alpha=0.4, label='Casos nuevos')
+    ax2.fill_between(fechas, nuevos, color='C1', alpha=0.4, label='Casos nuevos')
 
     ax2.set_xlabel('Fecha')
     ax1.set_ylabel('Casos acumulados')
-    ax1.plot(dfmun_tot.index, dfmun_tot.AcumuladoCasosHastaLaFecha, 'C0', label='Casos acumulados')
+    ax1.plot(fechas, acumulados, 'C0', label='Casos acumulados')
 
-    marcas_x = pd.date_range(start=df.first('D').index[0], end=df.last('D').index[0], freq='MS')
+    marcas_x = pd.date_range(start=fechas[1], end=fechas[-1], freq='MS') # Las fechas empiezan el día anterior al primer dato
     plt.xticks(marcas_x, marcas_x.strftime('%B'))
 
     fig.autofmt_xdate()
 
     fig.legend(loc="upper right", bbox_to_anchor=(0.4,1), bbox_transform=ax1.transAxes)
 
-    plt.title(municipio+' '+df.last('1D').index[0].strftime('%d-%m-%y'))
+    plt.title(municipio+' (último caso el '+fechas[-1].strftime('%d-%m-%y')+')')
 
     #fig.tight_layout()  # otherwise the right y-label is slightly clipped
 
-    plt.savefig('./Datos_municipios/{}/{}_plot.png'.format(municipio, municipio), dpi=300)
+    t_savefig = time.perf_counter()
+    plt.savefig(destino, format='png', dpi=300)
+    t_savefig = time.perf_counter()-t_savefig
 
     #plt.show()
 
     plt.close(fig)
 
-locale.setlocale(locale.LC_TIME, 'es_ES')
-
-df = pd.read_csv('CasosMunicipios_ZR_Covid.csv',encoding='latin-1', delimiter=';', parse_dates=[0]) # Cargamos datos
-
-df = df[df.CodZR != -1] #Eliminamos los datos Nulos/Sin informar
-df = df[df.CodMun != 0] #Eliminamos los datos de positivos de otras Comunidades Autónomas
-df = df[df.CodZR != 99]
-
-df = df.replace([' / ', '-'], '_', regex=True) # Renombremos los nombres en formato CASTELLANO / EUSKERA y CASTELLANO-EUSKERA para poder usarlos para crear directorios
-
-                                       # Creamos un directorio donde guardar los datos resumidos en caso de que no exista
-for municipio in df.DesMun.unique():
+    if ruta is not None:
+        os.replace(destino, ruta)
+
+    return time.perf_counter()-t0, t_savefig
+
+def GraficaPNG(municipio, inicio, nuevos, acumulados):
+    """Dibuja la gráfica en memoria y devuelve el PNG. Lo usa el bot para dibujar bajo demanda."""
+    png = io.BytesIO()
+    GeneraGrafica(municipio, inicio, nuevos, acumulados, png)
+    return png.getvalue()
+
+def GeneraGraficas(nuevos, acumulados, municipios, procesos=None):
+    """
+    Reparte las gráficas de los municipios entre `procesos` procesos (por
+    defecto uno por núcleo). Devuelve un diccionario con los municipios que
+    han fallado y su error. Los tiempos de cada gráfica se guardan en las métricas.
+    """
+    inicio = nuevos.columns[0]
+    errores = {}
+
+    if procesos == 1: # Sin paralelizar, útil para depurar
+        for municipio in municipios:
+            try:
+                t_grafica, t_savefig = GeneraGrafica(municipio, inicio, nuevos.loc[municipio].to_numpy(), acumulados.loc[municipio].to_numpy())
+                metricas.observa('updater_grafica_segundos', t_grafica)
+                metricas.observa('updater_savefig_segundos', t_savefig)
+            except Exception as error:
+                errores[municipio] = error
+        return errores
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=procesos, initializer=locale.setlocale, initargs=(locale.LC_TIME, LOCALE)) as pool:
+        futuros = {pool.submit(GeneraGrafica, municipio, inicio, nuevos.loc[municipio].to_numpy(), acumulados.loc[municipio].to_numpy()): municipio for municipio in municipios}
+
+        contador = 0
+        for futuro in concurrent.futures.as_completed(futuros):
+            municipio = futuros[futuro]
+            contador += 1
+            try:
+                t_grafica, t_savefig = futuro.result()
+                metricas.observa('updater_grafica_segundos', t_grafica)
+                metricas.observa('updater_savefig_segundos', t_savefig)
+                print('Gráfica {}/{}: {}'.format(contador, len(futuros), municipio))
+            except Exception as error:
+                errores[municipio] = error
+                print('Gráfica {}/{}: {} ha fallado ({})'.format(contador, len(futuros), municipio, error))
+
+    return errores
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Genera los datos y las gráficas de cada municipio.')
+    parser.add_argument('--procesos', type=int, default=None, help='Número de procesos para dibujar las gráficas (por defecto uno por núcleo)')
+    parser.add_argument('--full', action='store_true', help='Regenera todos los municipios aunque no hayan cambiado')
+    parser.add_argument('--bloque', type=int, default=None, help='Lee el csv por bloques de este número de filas')
+    parser.add_argument('--bajo-demanda', action='store_true', help='No dibuja las gráficas, las dibuja el bot cuando se piden')
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+
+    locale.setlocale(locale.LC_TIME, LOCALE)
+
+    df = CargaDatos(CSV, args.bloque)
+
+                                           # Creamos un directorio donde guardar los datos resumidos en caso de que no exista
+    for municipio in df.DesMun.unique():
+        try:
+            os.mkdir('./Datos_municipios/{}'.format(municipio))
+        except(FileExistsError):
+            pass
     try:
-        os.mkdir('./Datos_municipios/{}'.format(municipio))
+        os.mkdir('./Datos_municipios/NAVARRA')
     except(FileExistsError):
         pass
-try:
-    os.mkdir('./Datos_municipios/NAVARRA')
-except(FileExistsError):
-    pass
-
-df.Fecha = pd.to_datetime(df.Fecha) # Asignamos formato fecha a la fecha
-df = df.set_index('Fecha')          # y lo usamos como ínidce para usar el atributo .last
-
-# Calculamos para todo Navarra
-dfmun = df
-
-municipio = 'NAVARRA'
-
-dfmun_tot = pd.DataFrame(0, index=pd.date_range(start=df.first('D').index[0]-datetime.timedelta(days=1), end=df.last('D').index[0], freq='D'), columns=['NuevosCasos', 'AcumuladoCasosHastaLaFecha'])
-
-for fecha in dfmun_tot.index:
-    if fecha in dfmun.index:
-        dfmun_tot.loc[fecha].NuevosCasos +=  dfmun.loc[fecha].NuevosCasos.sum()
-        dfmun_tot.loc[fecha].AcumuladoCasosHastaLaFecha =  dfmun_tot.loc[fecha-datetime.timedelta(days=1)].AcumuladoCasosHastaLaFecha + dfmun.loc[fecha].NuevosCasos.sum()
-    elif fecha != df.first('D').index[0]-datetime.timedelta(days=1):
-        dfmun_tot.loc[fecha].AcumuladoCasosHastaLaFecha = dfmun_tot.loc[fecha-datetime.timedelta(days=1)].AcumuladoCasosHastaLaFecha
-
-GeneraDatos(dfmun_tot, municipio)
-
-
-contador = 1
-
-for municipio in df.DesMun.unique():   # Recorremos todos los municipios para recopilar los datos de cada uno
-    dfmun = df[df.DesMun == municipio]
-
-    dfmun_tot = pd.DataFrame(0, index=pd.date_range(start=df.first('D').index[0]-datetime.timedelta(days=1), end=df.last('D').index[0], freq='D'), columns=['NuevosCasos', 'AcumuladoCasosHastaLaFecha'])
-
-    for fecha in dfmun_tot.index:
-        if fecha in dfmun.index:
-            dfmun_tot.loc[fecha].NuevosCasos +=  dfmun.loc[fecha].NuevosCasos.sum()
-            dfmun_tot.loc[fecha].AcumuladoCasosHastaLaFecha =  dfmun_tot.loc[fecha-datetime.timedelta(days=1)].AcumuladoCasosHastaLaFecha + dfmun.loc[fecha].NuevosCasos.sum()
-        elif fecha != df.first('D').index[0]-datetime.timedelta(days=1):
-            dfmun_tot.loc[fecha].AcumuladoCasosHastaLaFecha = dfmun_tot.loc[fecha-datetime.timedelta(days=1)].AcumuladoCasosHastaLaFecha
-
-    GeneraDatos(dfmun_tot, municipio)
 
-    contador += 1
-    print('\n\n{}/{}: '.format(contador, len(df.DesMun.unique())))
\ No newline at end of file
+    with metricas.tramo('updater_etapa_segundos', etapa='agregacion'):
+        nuevos, acumulados, cubo = MatrizCasos(df) # Agregamos todos los municipios y Navarra de una vez
+        acumulados_zonas, zonas = TotalesZonas(cubo)
+
+    municipios = ['NAVARRA'] + list(df.DesMun.unique())
+
+    # Comparamos con lo procesado la última vez para saber qué municipios han cambiado
+    estado = {} if args.full else CargaEstado()
+    huellas = HuellasMunicipios(nuevos)
+    inicio = nuevos.columns[0].strftime('%Y-%m-%d')
+    ultima_fecha = nuevos.columns[-1].strftime('%Y-%m-%d')
+
+    if estado.get('Inicio') != inicio: # Si cambia el primer día cambian los ejes de todas las gráficas
+        estado = {}
+
+    huellas_previas = estado.get('Huellas', {})
+    cambiados = [municipio for municipio in municipios
+                 if huellas_previas.get(municipio) != huellas[municipio]
+                 or not (args.bajo_demanda or os.path.exists('./Datos_municipios/{}/{}_plot.png'.format(municipio, municipio)))]
+
+    nueva_fecha = estado.get('UltimaFecha') != ultima_fecha
+
+    print('{} de {} municipios han cambiado'.format(len(cambiados), len(municipios)))
+
+    contador = 0
+
+    with metricas.tramo('updater_etapa_segundos', etapa='json'):
+        # Los json llevan la fecha de los datos: si hay un día nuevo se reescriben todos
+        for municipio in (municipios if nueva_fecha else cambiados):   # Primero los datos de cada municipio, que son rápidos
+            GeneraDatos(nuevos.loc[municipio], acumulados.loc[municipio], municipio)
+
+            contador += 1
+            print('\n\n{}/{}: '.format(contador, len(municipios)))
+
+    if args.bajo_demanda: # Las gráficas viejas de los que han cambiado ya no valen, las dibujará el bot
+        errores = {}
+        for municipio in cambiados:
+            try:
+                os.remove('./Datos_municipios/{}/{}_plot.png'.format(municipio, municipio))
+            except(FileNotFoundError):
+                pass
+    else:
+        with metricas.tramo('updater_etapa_segundos', etapa='graficas'):
+            errores = GeneraGraficas(nuevos, acumulados, cambiados, args.procesos) # y después las gráficas de los que han cambiado, en paralelo
+
+    if errores:
+        print('\nNo se han podido generar {} gráficas:'.format(len(errores)))
+        for municipio, error in errores.items():
+            print('\t{}: {}'.format(municipio, error))
+
+    # La versión de la gráfica de cada municipio es su huella, salvo si ha fallado, que sigue la anterior
+    versiones = [huellas[municipio] if municipio not in errores else huellas_previas.get(municipio, '') for municipio in nuevos.index]
+
+    # El almacén es un solo archivo, así que se reescribe entero, en una instantánea nueva con el
+    # manifiesto y las gráficas que se publica de una vez cuando está completa
+    with metricas.tramo('updater_etapa_segundos', etapa='almacen'):
+        instantanea = publicacion.NuevaInstantanea()
+        EscribeAlmacen(os.path.join(instantanea, publicacion.ALMACEN), nuevos.index, inicio, nuevos.columns[-1].strftime('%d de %B de %Y'), nuevos.to_numpy(), acumulados.to_numpy(),
+                       pd.concat([nuevos.iloc[:, -15:].sum(axis=1), nuevos.iloc[:, -1], acumulados.iloc[:, -1]], axis=1).to_numpy(), versiones,
+                       zonas, acumulados_zonas.to_numpy(), CargaPoblacion(POBLACION))
+        EscribeManifiesto(os.path.join(instantanea, publicacion.MANIFIESTO), nuevos.index, zonas, ultima_fecha)
+        for municipio in nuevos.index:
+            publicacion.EnlazaGrafica(instantanea, municipio, './Datos_municipios/{}/{}_plot.png'.format(municipio, municipio))
+        publicacion.Publica(instantanea)
+
+    # Los municipios que han fallado se quedan sin huella para que se reintenten la próxima vez
+    GuardaEstado({'Inicio': inicio, 'UltimaFecha': ultima_fecha,
+                  'Huellas': {municipio: huellas[municipio] for municipio in municipios if municipio not in errores}})
+
+    metricas.fija('updater_municipios', len(municipios), tipo='total')
+    metricas.fija('updater_municipios', len(cambiados), tipo='cambiados')
+    metricas.fija('updater_municipios', len(errores), tipo='errores')
+    metricas.fija('updater_etapa_segundos', time.perf_counter()-t0, etapa='total')
+    metricas.fija('updater_ultima_ejecucion', time.time())
+    metricas.guarda(METRICAS)
+
+
+if __name__ == '__main__':
+    main()
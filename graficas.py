@@ -0,0 +1,108 @@
+"""
+Gráficas bajo demanda para el bot.
+
+Si data_updater.py se ejecuta con --bajo-demanda no dibuja las gráficas: el bot
+las dibuja la primera vez que se piden con Dibuja(), en otro proceso, y las
+guarda en una CacheGraficas.
+
+CacheGraficas es una caché LRU con dos niveles, uno en memoria y otro en disco,
+cada uno limitado en bytes. Las claves son (municipio, versión de la gráfica),
+así que cuando cambian los datos de un municipio su gráfica antigua deja de
+usarse y acaba saliendo de la caché.
+
+Este módulo no importa pandas ni matplotlib: Dibuja() importa data_updater
+dentro del proceso que dibuja.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+def InicializaProceso():
+    """Inicializador de los procesos que dibujan: importa data_updater y pone el locale."""
+    import locale
+    import data_updater
+    locale.setlocale(locale.LC_TIME, data_updater.LOCALE)
+
+def Dibuja(municipio, inicio, nuevos, acumulados):
+    """Dibuja la gráfica del municipio y devuelve el PNG."""
+    import data_updater
+    return data_updater.GraficaPNG(municipio, inicio, nuevos, acumulados)
+
+
+class CacheGraficas:
+
+    def __init__(self, directorio, max_memoria, max_disco):
+        self.directorio = directorio
+        self.max_memoria = max_memoria
+        self.max_disco = max_disco
+
+        self._cerrojo = threading.Lock()
+        self._memoria = OrderedDict() # clave -> PNG, de menos a más reciente
+        self._bytes_memoria = 0
+
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, clave):
+        municipio, version = clave
+        return os.path.join(self.directorio, hashlib.sha256('{}\n{}'.format(municipio, version).encode('utf-8')).hexdigest()+'.png')
+
+    def _a_memoria(self, clave, png):
+        with self._cerrojo:
+            if clave in self._memoria:
+                self._memoria.move_to_end(clave)
+                return
+            self._memoria[clave] = png
+            self._bytes_memoria += len(png)
+            while self._bytes_memoria > self.max_memoria and len(self._memoria) > 1:
+                _, viejo = self._memoria.popitem(last=False)
+                self._bytes_memoria -= len(viejo)
+
+    def _recorta_disco(self):
+        """Borra los archivos usados hace más tiempo hasta que el directorio cabe en max_disco."""
+        archivos = []
+        for entrada in os.scandir(self.directorio):
+            if entrada.is_file():
+                estado = entrada.stat()
+                archivos.append((estado.st_mtime, estado.st_size, entrada.path))
+
+        total = sum(tamano for mtime, tamano, ruta in archivos)
+        for mtime, tamano, ruta in sorted(archivos):
+            if total <= self.max_disco:
+                break
+            try:
+                os.remove(ruta)
+            except(FileNotFoundError):
+                pass
+            total -= tamano
+
+    def get(self, clave):
+        """Devuelve el PNG o None si no está ni en memoria ni en disco."""
+        with self._cerrojo:
+            png = self._memoria.get(clave)
+            if png is not None:
+                self._memoria.move_to_end(clave)
+                return png
+
+        ruta = self._ruta(clave)
+        try:
+            with open(ruta, 'rb') as fin:
+                png = fin.read()
+        except(FileNotFoundError):
+            return None
+
+        os.utime(ruta) # La fecha de modificación marca el último uso
+        self._a_memoria(clave, png)
+        return png
+
+    def put(self, clave, png):
+        self._a_memoria(clave, png)
+
+        ruta = self._ruta(clave)
+        with open(ruta+'.tmp', 'wb') as fout:
+            fout.write(png)
+        os.replace(ruta+'.tmp', ruta)
+
+        self._recorta_disco()
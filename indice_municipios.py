@@ -0,0 +1,175 @@
+"""
+Índice de nombres de municipios para identificar la localidad que escribe un
+usuario aunque tenga erratas, tildes o esté en Castellano o en Euskera.
+
+Se construye una sola vez a partir de la lista de municipios. Para cada
+nombre se guardan sus alias (el nombre completo y, si es de la forma
+CASTELLANO_EUSKERA, cada una de sus partes) sin tildes y en mayúsculas, y
+para cada alias los municipios a los que corresponde.
+
+La búsqueda da los mismos resultados que get_close_matches de difflib sobre
+la lista de alias, pero sin comparar con todos. get_close_matches descarta
+los alias cuya cota quick_ratio (letras en común) no llega al mínimo. Aquí
+esa cota se calcula para todos a la vez con un índice invertido de
+(letra, número de aparición) y solo se calcula el ratio completo de los
+alias que la superan, de más a menos letras en común y parando cuando ya
+no pueden entrar entre los mejores.
+
+Para el modo inline del bot, que consulta con cada letra que se escribe, hay
+además una búsqueda por prefijo (empiezan) con bisect sobre los alias
+ordenados.
+
+Para que el bot arranque rápido, data_updater.py guarda los índices ya
+construidos en un manifiesto (EscribeManifiesto) y el bot los carga de una
+sola lectura con IndiceMunicipios.carga(), que solo los vuelve a construir si
+el manifiesto no corresponde a la lista de municipios del almacén.
+"""
+
+import heapq
+import json
+import os
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+
+
+def Normaliza(texto):
+    """Pasa el texto a mayúsculas y le quita las tildes (la Ñ pasa a ser N)."""
+    return ''.join(c for c in unicodedata.normalize('NFKD', texto.upper()) if not unicodedata.combining(c))
+
+
+class IndiceMunicipios:
+
+    def __init__(self, municipios):
+        self.municipios = list(municipios)
+
+        normalizados = [Normaliza(municipio) for municipio in self.municipios]
+
+        # Alias de cada municipio en Castellano y Euskera, sin repetir
+        alias = {}
+        for normalizado in normalizados:
+            alias[normalizado] = None
+            if '_' in normalizado:
+                for parte in normalizado.split('_'):
+                    alias[parte] = None
+        self.alias = list(alias)
+
+        # Cada alias lleva a todos los municipios que lo contienen, en el orden de la lista
+        self.canonicos = {a: [municipio for municipio, normalizado in zip(self.municipios, normalizados) if a in normalizado] for a in self.alias}
+
+        # Índice invertido: (letra, k) -> alias con al menos k apariciones de esa letra
+        self._letras = defaultdict(list)
+        for i, a in enumerate(self.alias):
+            for letra, veces in Counter(a).items():
+                for k in range(1, veces+1):
+                    self._letras[(letra, k)].append(i)
+
+        self._ordenados = sorted(self.alias)
+
+    def estado(self):
+        """Todo lo que hace falta para reconstruir el índice sin calcularlo, como diccionario serializable en json."""
+        fila = {municipio: i for i, municipio in enumerate(self.municipios)}
+        letras = {}
+        for (letra, k), ids in self._letras.items():
+            letras.setdefault(letra, []).append([k, ids])
+        return {'Municipios': self.municipios, 'Alias': self.alias,
+                'Canonicos': [[fila[municipio] for municipio in self.canonicos[a]] for a in self.alias], 'Letras': letras}
+
+    @classmethod
+    def desde_estado(cls, estado):
+        indice = cls.__new__(cls)
+        indice.municipios = estado['Municipios']
+        indice.alias = estado['Alias']
+        indice.canonicos = {a: [indice.municipios[fila] for fila in filas] for a, filas in zip(indice.alias, estado['Canonicos'])}
+        indice._letras = {(letra, k): ids for letra, listas in estado['Letras'].items() for k, ids in listas}
+        indice._ordenados = sorted(indice.alias)
+        return indice
+
+    @classmethod
+    def carga(cls, estado, municipios):
+        """El índice guardado en `estado` si es de esos mismos municipios y, si no, uno nuevo."""
+        if estado is not None and estado['Municipios'] == list(municipios):
+            return cls.desde_estado(estado)
+        return cls(municipios)
+
+    def cercanos(self, texto, n=3, cutoff=0.6):
+        """Equivalente a get_close_matches(Normaliza(texto), self.alias, n, cutoff)."""
+        buscado = Normaliza(texto)
+
+        comunes = Counter() # alias -> número de letras en común con lo buscado
+        for letra, veces in Counter(buscado).items():
+            for k in range(1, veces+1):
+                comunes.update(self._letras.get((letra, k), ()))
+
+        # Recorremos los alias de más a menos letras en común. Como un alias tiene al
+        # menos tantas letras como las que comparte, 2*letras/(len(buscado)+letras)
+        # es una cota de su ratio que baja con las letras: cuando no llega al mínimo
+        # o al peor de los n mejores, ninguno de los que quedan puede entrar
+        comparador = SequenceMatcher()
+        comparador.set_seq2(buscado)
+
+        mejores = [] # montículo con los n mejores (ratio, alias)
+        for i, letras in comunes.most_common():
+            minimo = mejores[0][0] if len(mejores) == n else cutoff
+            if 2.0*letras/(len(buscado)+letras) < minimo:
+                break
+
+            a = self.alias[i]
+            if 2.0*letras/(len(buscado)+len(a)) < minimo: # quick_ratio
+                continue
+
+            comparador.set_seq1(a)
+            ratio = comparador.ratio()
+            if ratio >= cutoff:
+                if len(mejores) < n:
+                    heapq.heappush(mejores, (ratio, a))
+                else:
+                    heapq.heappushpop(mejores, (ratio, a))
+
+        return [a for ratio, a in sorted(mejores, reverse=True)]
+
+    def identifica(self, texto):
+        """Devuelve los municipios correspondientes a los alias más parecidos al texto."""
+        municipios = []
+
+        for a in self.cercanos(texto):
+            for municipio in self.canonicos[a]:
+                if municipio not in municipios:
+                    municipios.append(municipio)
+
+        return municipios
+
+
+    def empiezan(self, texto, n=10):
+        """Los primeros `n` municipios con algún alias que empieza por el texto, por orden alfabético del alias."""
+        buscado = Normaliza(texto).strip()
+        municipios = []
+
+        i = bisect_left(self._ordenados, buscado)
+        while i < len(self._ordenados) and self._ordenados[i].startswith(buscado) and len(municipios) < n:
+            for municipio in self.canonicos[self._ordenados[i]]:
+                if municipio not in municipios and len(municipios) < n:
+                    municipios.append(municipio)
+            i += 1
+
+        return municipios
+
+
+def EscribeManifiesto(ruta, municipios, zonas, version):
+    """
+    Escribe el manifiesto con los índices de los municipios y de las zonas
+    básicas y la versión de los datos (la fecha de los datos).
+    """
+    manifiesto = {'Version': version, 'Municipios': IndiceMunicipios(municipios).estado(), 'Zonas': IndiceMunicipios(zonas).estado()}
+    with open(ruta+'.tmp', 'w', encoding='utf-8') as fout:
+        json.dump(manifiesto, fout, ensure_ascii=False)
+    os.replace(ruta+'.tmp', ruta)
+
+def LeeManifiesto(ruta):
+    """Lee el manifiesto. Si no existe devuelve un diccionario vacío."""
+    try:
+        with open(ruta, encoding='utf-8') as fin:
+            return json.load(fin)
+    except(FileNotFoundError):
+        return {}
@@ -0,0 +1,145 @@
+"""
+Métricas de tiempos del updater y del bot en formato de texto de Prometheus.
+
+Hay dos tipos de métricas:
+    - valores (gauge), por ejemplo lo que ha tardado cada etapa del updater
+    - histogramas, por ejemplo la latencia de cada handler del bot
+
+Las dos se identifican por su nombre y sus etiquetas. tramo() mide el tiempo
+de un bloque con `with`. texto() devuelve todas las métricas en formato
+Prometheus y guarda() las escribe en un archivo, que puede leer el textfile
+collector de node_exporter.
+
+Cada programa usa el registro `metricas` de este módulo.
+"""
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIJO = 'covidatanav_'
+
+CUBOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+def _Etiquetas(etiquetas):
+    if not etiquetas:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(clave, str(valor).replace('\\', '\\\\').replace('"', '\\"')) for clave, valor in sorted(etiquetas)) + '}'
+
+
+class Histograma:
+
+    def __init__(self):
+        self.cubos = [0]*len(CUBOS)
+        self.suma = 0.0
+        self.cuenta = 0
+
+    def observa(self, valor):
+        self.cubos[bisect.bisect_left(CUBOS, valor)] += 1
+        self.suma += valor
+        self.cuenta += 1
+
+    def percentil(self, p):
+        """Estimación del percentil p (entre 0 y 1): el límite superior del cubo en el que cae."""
+        objetivo = p*self.cuenta
+        acumulado = 0
+        for limite, n in zip(CUBOS, self.cubos):
+            acumulado += n
+            if acumulado >= objetivo:
+                return limite
+        return CUBOS[-1]
+
+
+class Metricas:
+
+    def __init__(self):
+        self._cerrojo = threading.Lock()
+        self._valores = {}      # (nombre, etiquetas) -> valor
+        self._histogramas = {}  # (nombre, etiquetas) -> Histograma
+
+    def fija(self, nombre, valor, **etiquetas):
+        with self._cerrojo:
+            self._valores[(nombre, tuple(sorted(etiquetas.items())))] = valor
+
+    def observa(self, nombre, valor, **etiquetas):
+        with self._cerrojo:
+            clave = (nombre, tuple(sorted(etiquetas.items())))
+            if clave not in self._histogramas:
+                self._histogramas[clave] = Histograma()
+            self._histogramas[clave].observa(valor)
+
+    @contextmanager
+    def tramo(self, nombre, histograma=False, **etiquetas):
+        """Mide lo que tarda el bloque y lo guarda como valor o, si histograma=True, como observación."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            if histograma:
+                self.observa(nombre, time.perf_counter()-t0, **etiquetas)
+            else:
+                self.fija(nombre, time.perf_counter()-t0, **etiquetas)
+
+    def histogramas(self):
+        """Copia de los histogramas como {(nombre, etiquetas): Histograma}."""
+        with self._cerrojo:
+            return dict(self._histogramas)
+
+    def texto(self):
+        lineas = []
+        with self._cerrojo:
+            for nombre in sorted({nombre for nombre, etiquetas in self._valores}):
+                lineas.append('# TYPE {}{} gauge'.format(PREFIJO, nombre))
+                for (n, etiquetas), valor in sorted(self._valores.items()):
+                    if n == nombre:
+                        lineas.append('{}{}{} {}'.format(PREFIJO, nombre, _Etiquetas(etiquetas), valor))
+
+            for nombre in sorted({nombre for nombre, etiquetas in self._histogramas}):
+                lineas.append('# TYPE {}{} histogram'.format(PREFIJO, nombre))
+                for (n, etiquetas), histograma in sorted(self._histogramas.items(), key=lambda item: item[0]):
+                    if n != nombre:
+                        continue
+                    acumulado = 0
+                    for limite, cuenta in zip(CUBOS, histograma.cubos):
+                        acumulado += cuenta
+                        le = '+Inf' if limite == float('inf') else repr(limite)
+                        lineas.append('{}{}_bucket{} {}'.format(PREFIJO, nombre, _Etiquetas(etiquetas + (('le', le),)), acumulado))
+                    lineas.append('{}{}_sum{} {}'.format(PREFIJO, nombre, _Etiquetas(etiquetas), histograma.suma))
+                    lineas.append('{}{}_count{} {}'.format(PREFIJO, nombre, _Etiquetas(etiquetas), histograma.cuenta))
+
+        return '\n'.join(lineas) + '\n'
+
+    def guarda(self, ruta):
+        """Escribe las métricas en `ruta` (se escribe aparte y se renombra)."""
+        texto = self.texto()
+        with open(ruta+'.tmp', 'w') as fout:
+            fout.write(texto)
+        os.replace(ruta+'.tmp', ruta)
+
+
+def LeeValores(ruta):
+    """Lee los valores (no los histogramas) de un archivo escrito con guarda() como [(nombre, etiquetas, valor)]."""
+    valores = []
+    try:
+        with open(ruta) as fin:
+            lineas = fin.read().splitlines()
+    except(FileNotFoundError):
+        return valores
+
+    tipos = {}
+    for linea in lineas:
+        if linea.startswith('# TYPE '):
+            nombre, tipo = linea[len('# TYPE '):].split()
+            tipos[nombre] = tipo
+        elif linea and not linea.startswith('#'):
+            serie, valor = linea.rsplit(' ', 1)
+            nombre, _, etiquetas = serie.partition('{')
+            if tipos.get(nombre) == 'gauge':
+                valores.append((nombre[len(PREFIJO):], etiquetas.rstrip('}'), float(valor)))
+    return valores
+
+
+metricas = Metricas()
@@ -0,0 +1,136 @@
+"""
+Publicación de los datos que lee el bot en instantáneas con versión.
+
+data_updater.py escribe cada ejecución en un directorio nuevo dentro de
+Publicado/ (el almacén, el manifiesto y las gráficas de los municipios) y,
+cuando está completo, cambia el puntero Publicado/ACTUAL, que es un archivo
+de texto con el nombre del directorio, con un renombrado atómico. Quien lee
+el puntero ve siempre una instantánea entera, la anterior o la nueva, nunca
+una mezcla. Se conservan las CONSERVAR últimas instantáneas.
+
+El bot carga la instantánea actual con Instantanea y comprueba de vez en
+cuando con Vigilante si el puntero ha cambiado (basta con mirar su fecha de
+modificación) para cargar la nueva sin reiniciarse.
+
+Las gráficas de la instantánea son enlaces duros a las de Datos_municipios,
+que data_updater.py sustituye con un renombrado al redibujarlas, así que
+cada instantánea conserva las suyas sin copiar nada.
+"""
+
+import os
+import shutil
+import time
+from collections import OrderedDict
+
+from almacen import Almacen
+from indice_municipios import IndiceMunicipios, LeeManifiesto
+
+PUBLICADO = './Publicado'
+PUNTERO = 'ACTUAL'
+CONSERVAR = 3
+
+ALMACEN = 'Datos_municipios.bin'
+MANIFIESTO = 'Manifiesto.json'
+GRAFICAS = 'graficas'
+
+
+def NuevaInstantanea(base=PUBLICADO):
+    """Crea el directorio de una instantánea nueva y devuelve su ruta. No se ve hasta que se llama a Publica()."""
+    nombre = '{}_{}'.format(time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+    directorio = os.path.join(base, nombre)
+    os.makedirs(os.path.join(directorio, GRAFICAS))
+    return directorio
+
+def EnlazaGrafica(directorio, municipio, ruta):
+    """Añade a la instantánea la gráfica del municipio que está en `ruta`, si existe."""
+    destino = os.path.join(directorio, GRAFICAS, municipio+'.png')
+    try:
+        os.link(ruta, destino)
+    except(FileNotFoundError):
+        pass
+    except(OSError): # El sistema de archivos no admite enlaces duros
+        shutil.copyfile(ruta, destino)
+
+def Publica(directorio, conservar=CONSERVAR):
+    """Hace que `directorio` sea la instantánea actual y borra las más antiguas."""
+    base, nombre = os.path.split(os.path.normpath(directorio))
+    puntero = os.path.join(base, PUNTERO)
+
+    with open(puntero+'.tmp', 'w') as fout:
+        fout.write(nombre)
+    os.replace(puntero+'.tmp', puntero)
+
+    instantaneas = sorted(entrada.name for entrada in os.scandir(base) if entrada.is_dir())
+    for viejo in instantaneas[:-conservar]:
+        if viejo != nombre:
+            shutil.rmtree(os.path.join(base, viejo), ignore_errors=True)
+
+def Actual(base=PUBLICADO):
+    """Ruta de la instantánea actual o None si todavía no se ha publicado ninguna."""
+    try:
+        with open(os.path.join(base, PUNTERO)) as fin:
+            return os.path.join(base, fin.read().strip())
+    except(FileNotFoundError):
+        return None
+
+
+class Instantanea:
+    """
+    Todo lo que el bot lee de una publicación: el almacén, los índices de
+    nombres y las gráficas. Sin `directorio` se usan los archivos que
+    data_updater.py dejaba antes en el directorio de trabajo.
+    """
+
+    def __init__(self, directorio=None):
+        self.directorio = directorio
+        base = '.' if directorio is None else directorio
+
+        self.almacen = Almacen(os.path.join(base, ALMACEN))
+
+        manifiesto = LeeManifiesto(os.path.join(base, MANIFIESTO))
+        self.indice = IndiceMunicipios.carga(manifiesto.get('Municipios'), self.almacen.municipios)
+        self.indice_zonas = IndiceMunicipios.carga(manifiesto.get('Zonas'), self.almacen.zonas)
+
+        # Resultados que el bot calcula con esta instantánea y guarda para reutilizarlos (los
+        # de las consultas inline). Se descartan con ella cuando se carga otra
+        self.memo = OrderedDict()
+
+    def grafica(self, municipio):
+        """Ruta de la gráfica del municipio que ha dibujado data_updater.py (puede no existir)."""
+        if self.directorio is None:
+            return './Datos_municipios/{}/{}_plot.png'.format(municipio, municipio)
+        return os.path.join(self.directorio, GRAFICAS, municipio+'.png')
+
+
+class Vigilante:
+    """
+    Avisa de cuándo cambia la instantánea actual mirando la fecha de
+    modificación del puntero. Hasta que no se llama a cargada() se sigue
+    avisando, por si no se ha podido cargar.
+    """
+
+    def __init__(self, base=PUBLICADO):
+        self.base = base
+        self.directorio = None
+        self._mtime = None
+        self._visto = None
+
+    def cambiada(self):
+        """Devuelve la ruta de la instantánea actual si no es la cargada y, si no, None."""
+        try:
+            mtime = os.stat(os.path.join(self.base, PUNTERO)).st_mtime_ns
+        except(FileNotFoundError):
+            return None
+        if mtime == self._mtime:
+            return None
+
+        self._visto = mtime
+        directorio = Actual(self.base)
+        if directorio == self.directorio:
+            self._mtime = mtime
+            return None
+        return directorio
+
+    def cargada(self, directorio):
+        self.directorio = directorio
+        self._mtime = self._visto
@@ -0,0 +1,55 @@
+"""
+Almacén de las suscripciones al envío diario (/configurar) en SQLite.
+
+Cada chat tiene como mucho una suscripción (municipio y hora). La tabla tiene
+como clave el chat y un índice por (hora, municipio), así que tanto dar de
+baja a un chat como sacar todos los suscriptores de una hora agrupados por
+municipio son consultas indexadas.
+
+La conexión se comparte entre hilos (el bot la usa con asyncio.to_thread), así
+que cada operación se hace con un cerrojo.
+"""
+
+import sqlite3
+import threading
+
+
+class Suscripciones:
+
+    def __init__(self, ruta='./suscripciones.db'):
+        self._cerrojo = threading.Lock()
+        self._conexion = sqlite3.connect(ruta, check_same_thread=False)
+
+        with self._cerrojo, self._conexion:
+            self._conexion.execute('PRAGMA journal_mode=WAL')
+            self._conexion.execute('CREATE TABLE IF NOT EXISTS suscripciones ('
+                                   'chat_id INTEGER PRIMARY KEY, municipio TEXT NOT NULL, hora INTEGER NOT NULL)')
+            self._conexion.execute('CREATE INDEX IF NOT EXISTS hora_municipio ON suscripciones (hora, municipio)')
+
+    def suscribe(self, chat_id, municipio, hora):
+        """Guarda la suscripción del chat, sustituyendo la anterior si la hay."""
+        with self._cerrojo, self._conexion:
+            self._conexion.execute('INSERT OR REPLACE INTO suscripciones (chat_id, municipio, hora) VALUES (?, ?, ?)',
+                                   (chat_id, municipio, hora))
+
+    def desuscribe(self, chat_id):
+        """Borra la suscripción del chat. Devuelve False si no tenía ninguna."""
+        with self._cerrojo, self._conexion:
+            return self._conexion.execute('DELETE FROM suscripciones WHERE chat_id = ?', (chat_id,)).rowcount > 0
+
+    def de_chat(self, chat_id):
+        """Devuelve (municipio, hora) de la suscripción del chat o None."""
+        with self._cerrojo:
+            return self._conexion.execute('SELECT municipio, hora FROM suscripciones WHERE chat_id = ?', (chat_id,)).fetchone()
+
+    def de_hora(self, hora):
+        """Devuelve un diccionario {municipio: [chat_id, ...]} con los suscriptores de esa hora."""
+        por_municipio = {}
+        with self._cerrojo:
+            for municipio, chat_id in self._conexion.execute('SELECT municipio, chat_id FROM suscripciones WHERE hora = ? ORDER BY municipio', (hora,)):
+                por_municipio.setdefault(municipio, []).append(chat_id)
+        return por_municipio
+
+    def total(self):
+        with self._cerrojo:
+            return self._conexion.execute('SELECT COUNT(*) FROM suscripciones').fetchone()[0]